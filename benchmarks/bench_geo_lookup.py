@@ -0,0 +1,74 @@
+"""归属地查询基准：原始路径（vector index 文件查询 + 逐次区域串解析）vs 当前路径（mmap 索引查询 + 区域串 LRU）的 lookups/sec。
+
+负载模拟一次运行的逐 IP 查询量：data/discovery.txt 每个 C段 的 3 个抽样 IP，
+加上 output/source-ip.txt 的复核 IP，重复 --rounds 轮。
+（流水线中 C段 预过滤与通过的复核 IP 已改查 /24 预编译表，实际逐 IP 查询只剩混合 /24 与被剔除的 IP。）
+
+用法（仓库根目录）：
+    python benchmarks/bench_geo_lookup.py [--db data/ip2region.xdb] [--rounds 20]
+"""
+import os, sys, time, argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ip2region.util as ip2region_util
+import ip2region.searcher as ip2region_searcher
+import main
+
+
+def _workload():
+    segs, hosts = [], []
+    with open(os.path.join(ROOT, main.DISCOVERY_FILE), encoding="utf-8") as f:
+        segs = [line.strip().split("|")[1] for line in f if line.startswith("SEG|")]
+    source_ip = os.path.join(ROOT, main.SOURCE_IP_FILE)
+    if os.path.exists(source_ip):
+        with open(source_ip, encoding="utf-8") as f:
+            hosts = [line.strip().split(":")[0] for line in f if line.strip()]
+    return [f"{seg}.{o}" for seg in segs for o in main.SAMPLE_IPS_PER_SEG] + hosts
+
+
+def _vector_index_searcher(db):
+    """优化前的查询器：文件句柄 + 预载 vector index（每次查询 seek/read 数据块）"""
+    header = ip2region_util.load_header_from_file(db)
+    version = ip2region_util.version_from_header(header)
+    return ip2region_searcher.new_with_vector_index(version, db, ip2region_util.load_vector_index_from_file(db))
+
+
+def _original(searcher):
+    parse = main._region_verdict.__wrapped__
+
+    def run(ips):
+        for ip in ips:
+            parse(searcher.search(ip))
+    return run
+
+
+def _current(ips):
+    for ip in ips:
+        main.get_geo_info(ip)
+
+
+def _batch(ips):
+    main.get_geo_info_many(ips)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=main.IP2REGION_DB)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    main.IP2REGION_DB = args.db
+
+    ips = _workload()
+    original = _vector_index_searcher(args.db)
+    print(f"负载: {len(ips)} 次查询/轮 × {args.rounds} 轮 | xdb: {args.db}")
+    for name, fn in (("原始逐IP", _original(original)), ("当前逐IP", _current), ("当前批量", _batch)):
+        main._region_verdict.cache_clear()
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            fn(ips)
+        elapsed = time.perf_counter() - start
+        print(f"  {name:<6} {len(ips) * args.rounds / elapsed:>10.0f} lookups/s | {elapsed:.3f}s")
+    print(f"  缓存统计: {main.geo_cache_summary()}")
+    original.close()
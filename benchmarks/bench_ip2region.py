@@ -0,0 +1,58 @@
+"""ip2region 查询核心基准 + 一致性校验：vectorIndex（原始二分，逐字节比较）/ mmap / mmap+indexed（整数数组 bisect）。
+
+对 --samples 个随机 IPv4 逐一比较各策略的 search 结果，任何不一致即以非 0 退出；
+一致时输出各策略 lookups/sec（indexed 分冷启动首轮与解码完成后的热轮）。
+
+用法（仓库根目录）：
+    python benchmarks/bench_ip2region.py [--db data/ip2region.xdb] [--samples 200000] [--seed 1]
+"""
+import os, sys, time, random, argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ip2region.util as util
+import ip2region.searcher as searcher
+
+
+def _timed(fn, ips):
+    start = time.perf_counter()
+    results = [fn(ip) for ip in ips]
+    return results, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=os.path.join(ROOT, "data", "ip2region.xdb"))
+    parser.add_argument("--samples", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    version = util.version_from_header(util.load_header_from_file(args.db))
+    rnd = random.Random(args.seed)
+    ips = [".".join(str(rnd.randrange(256)) for _ in range(4)) for _ in range(args.samples)]
+
+    baseline = searcher.new_with_vector_index(version, args.db, util.load_vector_index_from_file(args.db))
+    mapped = searcher.new_with_mmap(version, args.db)
+    indexed = searcher.new_with_mmap(version, args.db, indexed=True)
+
+    expected, t_base = _timed(baseline.search, ips)
+    runs = [("vectorIndex", expected, t_base)]
+    runs.append(("mmap", *_timed(mapped.search, ips)))
+    runs.append(("indexed 冷", *_timed(indexed.search, ips)))
+    runs.append(("indexed 热", *_timed(indexed.search, ips)))
+    start = time.perf_counter()
+    runs.append(("indexed 批量", indexed.search_many(ips), time.perf_counter() - start))
+
+    print(f"xdb: {args.db} | 随机样本: {args.samples} | seed={args.seed}")
+    mismatched = False
+    for name, results, elapsed in runs:
+        diff = sum(1 for a, b in zip(expected, results) if a != b)
+        mismatched |= diff > 0
+        print(f"  {name:<12} {args.samples / elapsed:>10.0f} lookups/s | {elapsed:.3f}s | 不一致 {diff}")
+
+    for s in (baseline, mapped, indexed):
+        s.close()
+    if mismatched:
+        sys.exit("❌ 查询结果不一致")
+    print("✅ 各策略结果逐条一致")
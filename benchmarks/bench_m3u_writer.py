@@ -0,0 +1,88 @@
+"""M3U 写出基准：列表构建 + join / 生成器流式写入 / 单次遍历多格式写出（write_outputs）的峰值内存与耗时。
+
+模拟 servers × channels 交叉积：默认 40 台服务器 × RTP 模板频道数（模板缺失时 300 个），
+--scales 为服务器数倍数（组合总数随之线性增长：1x 当前、10x、100x）。
+三种写法的输出逐字节比对，不一致时非零退出。
+
+用法（仓库根目录）：
+    python benchmarks/bench_m3u_writer.py [--servers 40] [--scales 1 10 100]
+"""
+import os, sys, time, argparse, tempfile, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import utils
+
+RTP_FILE = os.path.join(ROOT, "data", "rtp", "ChinaTelecom-Guangdong.txt")
+
+
+def _entries():
+    entries = utils.parse_rtp_entries(RTP_FILE)
+    return entries or [(f"频道{i}", f"239.77.{i // 256}.{i % 256}:5146") for i in range(300)]
+
+
+def _hostports(n):
+    return [f"10.{i // 65536}.{i // 256 % 256}.{i % 256}:4022" for i in range(n)]
+
+
+def _list_write(path, entries, hps):
+    utils.atomic_write(path, "\n".join(utils.build_m3u(entries, hps)))
+    utils.atomic_write(path + ".compat", "\n".join(utils.build_compat(entries, hps)))
+
+
+def _stream_write(path, entries, hps):
+    utils.atomic_write_lines(path, utils.iter_m3u(entries, hps))
+    utils.atomic_write_lines(path + ".compat", utils.iter_compat(entries, hps))
+
+
+def _fused_write(path, entries, hps):
+    # 只比较写出路径本身：关闭压缩副本（OUTPUT_COMPRESS）
+    utils.write_outputs([(path, "m3u"), (path + ".compat", "compat")], entries, hps)
+
+
+def _measure(fn, *args):
+    """返回 (峰值内存, 耗时)；耗时单独测一遍，避免 tracemalloc 的开销扭曲对比"""
+    t0 = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - t0
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+def _same(a, b):
+    with open(a, "rb") as fa, open(b, "rb") as fb:
+        return fa.read() == fb.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--servers", type=int, default=40, help="基准服务器数（1x）")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    args = parser.parse_args()
+
+    entries = _entries()
+    utils.OUTPUT_COMPRESS = []
+    ok = True
+    print(f"频道数: {len(entries)} | 写出 M3U + 兼容格式两份文件")
+    print(f"{'规模':>6} {'组合数':>10} {'列表峰值':>10} {'流式峰值':>10} {'单遍峰值':>10} "
+          f"{'列表耗时':>9} {'流式耗时':>9} {'单遍耗时':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scales:
+            hps = _hostports(args.servers * scale)
+            paths = [os.path.join(tmp, f"{name}.m3u") for name in ("list", "stream", "fused")]
+            results = [_measure(fn, path, entries, hps)
+                       for fn, path in zip((_list_write, _stream_write, _fused_write), paths)]
+            same = all(_same(paths[0] + ext, p + ext) for p in paths[1:] for ext in ("", ".compat"))
+            ok &= same
+            peaks = " ".join(f"{peak / 2**20:>8.1f}MB" for peak, _ in results)
+            times = " ".join(f"{sec:>8.2f}s" for _, sec in results)
+            print(f"{scale:>5}x {len(hps) * len(entries):>10} {peaks} {times}{'' if same else '  ❌ 输出不一致'}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""扫描引擎基准：本地 udpxy 模拟服务上对比 httpx / raw 两条 check_udpxy 路径的 probes/sec。
+
+用法（仓库根目录）：
+    python benchmarks/bench_scan_engine.py [--probes 5000] [--workers 500]
+"""
+import os, sys, time, asyncio, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import main
+
+STATUS_BODY = (b"<html><head><title>udpxy status</title></head><body>"
+               b"<h1>udpxy status</h1>" + b"<p>client</p>" * 40 + b"</body></html>")
+STATUS_RESPONSE = (b"HTTP/1.1 200 OK\r\nServer: udpxy 1.0-25.1\r\nContent-Type: text/html\r\n"
+                   b"Content-Length: " + str(len(STATUS_BODY)).encode() + b"\r\nConnection: close\r\n\r\n" + STATUS_BODY)
+
+
+async def _handle(reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(STATUS_RESPONSE)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _bench(engine, port, probes, workers):
+    sem = asyncio.Semaphore(workers)
+    hits = 0
+    async with httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=200, max_connections=1000)) as client:
+        async def one():
+            async with sem:
+                if engine == "raw":
+                    return await main.check_udpxy_raw(f"127.0.0.1:{port}")
+                return await main.check_udpxy(f"127.0.0.1:{port}", client=client)
+
+        start = time.perf_counter()
+        for ok, _ in await asyncio.gather(*(one() for _ in range(probes))):
+            hits += ok
+        elapsed = time.perf_counter() - start
+    return hits, elapsed
+
+
+async def _run(args):
+    server = await asyncio.start_server(_handle, "127.0.0.1", 0, backlog=4096)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        print(f"本地 udpxy 模拟: 127.0.0.1:{port} | 探测 {args.probes} 次 | 并发 {args.workers}")
+        for engine in ("httpx", "raw"):
+            hits, elapsed = await _bench(engine, port, args.probes, args.workers)
+            print(f"  {engine:<6} {args.probes / elapsed:>9.0f} probes/s | 命中 {hits}/{args.probes} | {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--probes", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=500)
+    asyncio.run(_run(parser.parse_args()))
@@ -0,0 +1,260 @@
+"""离线基准：本地回环上的模拟 udpxy 服务器群，驱动真实的扫描 / 指纹 / 测速代码。
+
+服务器群运行在独立进程（独立事件循环，不占用被测进程的 CPU 与事件循环），按 --mix 在
+127.77.<段>.<主机> 上分配以下类型，其余主机为关闭端口（connect 立即被拒）：
+  status       /status 返回 udpxy 页面，/rtp/ 返回 200 后立即断开（组播无流）
+  stream       /status 同上，/rtp/ 按 --bitrates 指定码率（Mbps，轮流分配）持续推送合法 MPEG-TS
+  slow_accept  监听但从不 accept，且 backlog 已占满 → SYN 被丢弃，客户端 connect 超时
+  slow_read    accept 后迟迟不响应（--slow-delay 秒），客户端 read 超时
+
+分三个阶段测量（各阶段前清零 utils.METRICS）：
+  scan   main.run_native_scan 全量扫描全部 C段（connect 快筛 + 指纹），按 --engines 逐个引擎
+  check  main.check_udpxy / check_udpxy_raw 逐个探测全部 ip:port，逐次计时
+  probe  probe.async_fast_ip_probe 测速全部监听中的服务器，stream 类型附带测得码率相对设定值的误差
+输出 ops/s、p50 / p99 时延与每次操作的 CPU 时间（仅被测进程）。
+
+依赖 Linux 回环（127.0.0.0/8 全段可直接绑定）；macOS 需先为 lo0 添加 127.77.x.x 别名。
+
+用法（仓库根目录）：
+    python benchmarks/bench_udpxy_farm.py [--segments 2] [--mix status=40 stream=20 slow_accept=10 slow_read=10]
+                                          [--bitrates 2 4 8] [--engines httpx raw] [--stages scan check probe]
+"""
+import os, sys, time, random, socket, asyncio, argparse, multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main
+import probe
+from utils import METRICS
+
+KINDS = ("status", "stream", "slow_accept", "slow_read")
+SEGMENT_PREFIX = "127.77"
+RTP_IDS = ["239.77.0.1:5140", "239.77.0.2:5140", "239.77.0.3:5140"]
+TICK = 0.02  # TS 推流节拍（秒）
+
+STATUS_BODY = (b"<html><head><title>udpxy status</title></head><body>"
+               b"<h1>udpxy status</h1>" + b"<p>client</p>" * 40 + b"</body></html>")
+STATUS_RESPONSE = (b"HTTP/1.1 200 OK\r\nServer: udpxy 1.0-25.1\r\nContent-Type: text/html\r\n"
+                   b"Content-Length: " + str(len(STATUS_BODY)).encode() + b"\r\nConnection: close\r\n\r\n" + STATUS_BODY)
+STREAM_HEADER = b"HTTP/1.1 200 OK\r\nServer: udpxy 1.0-25.1\r\nContent-Type: application/octet-stream\r\n\r\n"
+
+
+def _ts_packets(count, cc):
+    """count 个 PID 0x100 的 TS 包（连续计数器从 cc 起递增），返回 (bytes, 下一个 cc)"""
+    buf = bytearray()
+    for _ in range(count):
+        buf += bytes((0x47, 0x01, 0x00, 0x10 | cc)) + b"\xff" * 184
+        cc = (cc + 1) & 0x0F
+    return bytes(buf), cc
+
+
+def build_layout(segments, mix, bitrates, seed):
+    """把 mix 中各类型服务器随机分布到 segments 个 C段；返回 [(ip, kind, 码率 Mbps 或 None)]"""
+    hosts = [f"{SEGMENT_PREFIX}.{seg}.{i}" for seg in range(segments) for i in range(1, 255)]
+    kinds = [kind for kind in KINDS for _ in range(mix.get(kind, 0))]
+    if len(kinds) > len(hosts):
+        raise SystemExit(f"--mix 共 {len(kinds)} 台，超过 {segments} 个 C段 的 {len(hosts)} 个主机")
+    rng = random.Random(seed)
+    layout, streams = [], 0
+    for ip, kind in zip(rng.sample(hosts, len(kinds)), kinds):
+        rate = None
+        if kind == "stream":
+            rate = bitrates[streams % len(bitrates)]
+            streams += 1
+        layout.append((ip, kind, rate))
+    return sorted(layout)
+
+
+async def _farm(layout, port, slow_delay, ready):
+    async def _handler(kind, rate):
+        async def handle(reader, writer):
+            try:
+                request = await reader.readuntil(b"\r\n\r\n")
+                if kind == "slow_read":
+                    await asyncio.sleep(slow_delay)
+                if request.split(b" ", 2)[1].startswith(b"/status"):
+                    writer.write(STATUS_RESPONSE)
+                elif kind == "stream":
+                    writer.write(STREAM_HEADER)
+                    per_tick = max(1, round(rate * 1_000_000 / 8 * TICK / 188))
+                    loop, cc = asyncio.get_running_loop(), 0
+                    next_at = loop.time()
+                    while True:
+                        chunk, cc = _ts_packets(per_tick, cc)
+                        writer.write(chunk)
+                        await writer.drain()
+                        next_at += TICK
+                        await asyncio.sleep(max(0.0, next_at - loop.time()))
+                else:
+                    writer.write(STREAM_HEADER)
+                await writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError, IndexError):
+                pass
+            finally:
+                writer.close()
+        return handle
+
+    servers, held = [], []
+    for ip, kind, rate in layout:
+        if kind == "slow_accept":
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((ip, port))
+            sock.listen(0)
+            # 占满 accept 队列：之后的 SYN 被内核丢弃，表现为 connect 超时
+            for _ in range(2):
+                filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                filler.setblocking(False)
+                filler.connect_ex((ip, port))
+                held.append(filler)
+            held.append(sock)
+        else:
+            servers.append(await asyncio.start_server(await _handler(kind, rate), ip, port,
+                                                      backlog=1024, reuse_address=True))
+    ready.send(True)
+    await asyncio.Event().wait()
+
+
+def _farm_process(layout, port, slow_delay, ready):
+    asyncio.run(_farm(layout, port, slow_delay, ready))
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _pct(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * (len(values) - 1) + 0.5))]
+
+
+def _row(stage, ops, ok, elapsed, cpu, p50, p99, extra=""):
+    fmt = lambda v: "-" if v is None else f"{v:.1f}"
+    print(f"  {stage:<14} {ops:>7} {ok:>6} {ops / elapsed if elapsed else 0:>9.1f} "
+          f"{fmt(p50):>8} {fmt(p99):>8} {cpu / max(ops, 1) * 1000:>9.3f}  {extra}")
+
+
+async def _stage_scan(engine, segments, port, expected):
+    main.SCAN_ENGINE = engine
+    METRICS.reset()
+    stats = {}
+    wall, cpu = time.perf_counter(), time.process_time()
+    alive, _ = await main.run_native_scan(segments, [port], set(), stats, verify_known=False)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    hist = METRICS.snapshot()["histograms"]
+    # 全量扫描的逐次时延只有直方图（分桶估算）：取 connect 快筛与指纹两段中的指纹段
+    fp = hist.get("scan.fingerprint_ms", {})
+    sweep = hist.get("sweep.connect_ms", {})
+    _row(f"scan/{engine}", stats.get("scan_completed", 0), len(alive), wall, cpu, fp.get("p50"), fp.get("p99"),
+         f"命中 {len(alive)}/{expected} | 快筛 p50/p99 {sweep.get('p50')}/{sweep.get('p99')}ms（分桶）")
+
+
+async def _stage_check(engine, targets, workers, expected):
+    sem = asyncio.Semaphore(workers)
+    latencies = []
+    async with probe.new_probe_client() as client:
+        async def one(hp):
+            async with sem:
+                t0 = time.perf_counter()
+                if engine == "raw":
+                    ok, _ = await main.check_udpxy_raw(hp)
+                else:
+                    ok, _ = await main.check_udpxy(hp, client=client)
+                latencies.append((time.perf_counter() - t0) * 1000)
+                return ok
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        hits = sum(await asyncio.gather(*(one(hp) for hp in targets)))
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    _row(f"check/{engine}", len(targets), hits, wall, cpu, _pct(latencies, 0.5), _pct(latencies, 0.99),
+         f"命中 {hits}/{expected}")
+
+
+async def _stage_probe(layout, port, workers):
+    sem = asyncio.Semaphore(workers)
+    latencies, errors = [], []
+    rates = {f"{ip}:{port}": rate for ip, _, rate in layout}
+    targets = [f"{ip}:{port}" for ip, _, _ in layout]
+    METRICS.reset()
+    async with probe.new_probe_client() as client:
+        async def one(hp):
+            async with sem:
+                t0 = time.perf_counter()
+                ok, _, bw, _, _ = await probe.async_fast_ip_probe(client, hp, probe.probe_urls(hp, RTP_IDS))
+                latencies.append((time.perf_counter() - t0) * 1000)
+                if rates[hp] and ok:
+                    errors.append(abs(bw - rates[hp]) / rates[hp] * 100)
+                return ok
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        ok = sum(await asyncio.gather(*(one(hp) for hp in targets)))
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    streams = sum(1 for r in rates.values() if r)
+    accuracy = f" | 码率误差 均值 {sum(errors) / len(errors):.1f}% 最大 {max(errors):.1f}%" if errors else ""
+    _row("probe", len(targets), ok, wall, cpu, _pct(latencies, 0.5), _pct(latencies, 0.99),
+         f"有流 {ok}/{streams} | 下载 {METRICS.counters.get('probe.bytes', 0) / 2**20:.1f}MB{accuracy}")
+
+
+async def _run(args, layout, port):
+    segments = [f"{SEGMENT_PREFIX}.{seg}" for seg in range(args.segments)]
+    listeners = sum(1 for _, kind, _ in layout if kind in ("status", "stream"))
+    print(f"{'阶段':<14} {'次数':>7} {'成功':>6} {'ops/s':>9} {'p50ms':>8} {'p99ms':>8} {'CPU ms/次':>9}")
+    if "scan" in args.stages:
+        for engine in args.engines:
+            await _stage_scan(engine, segments, port, listeners)
+    if "check" in args.stages:
+        targets = [f"{seg}.{i}:{port}" for seg in segments for i in range(1, 255)]
+        for engine in args.engines:
+            await _stage_check(engine, targets, args.scan_workers, listeners)
+    if "probe" in args.stages:
+        await _stage_probe(layout, port, args.probe_workers)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--segments", type=int, default=2, help="C段 数（每段 254 个主机）")
+    parser.add_argument("--mix", nargs="+", default=["status=40", "stream=20", "slow_accept=10", "slow_read=10"],
+                        help=f"各类型服务器台数（{'/'.join(KINDS)}），其余主机为关闭端口")
+    parser.add_argument("--bitrates", type=float, nargs="+", default=[2, 4, 8], help="stream 服务器码率（Mbps，轮流分配）")
+    parser.add_argument("--slow-delay", type=float, default=8.0, help="slow_read 服务器响应前的等待秒数")
+    parser.add_argument("--engines", nargs="+", choices=("httpx", "raw"), default=["httpx", "raw"])
+    parser.add_argument("--stages", nargs="+", choices=("scan", "check", "probe"), default=["scan", "check", "probe"])
+    parser.add_argument("--scan-workers", type=int, default=int(os.environ.get("SCAN_WORKERS", "500")))
+    parser.add_argument("--probe-workers", type=int, default=int(os.environ.get("PROBE_WORKERS", "50")))
+    parser.add_argument("--port", type=int, default=0, help="服务器群监听端口（0 = 自动选择）")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    mix = {}
+    for item in args.mix:
+        kind, _, count = item.partition("=")
+        if kind not in KINDS or not count.isdigit():
+            parser.error(f"--mix 项格式应为 类型=台数，类型取 {'/'.join(KINDS)}：{item}")
+        mix[kind] = int(count)
+    port = args.port or _free_port()
+    layout = build_layout(args.segments, mix, args.bitrates, args.seed)
+
+    ctx = multiprocessing.get_context("spawn")
+    ready, child_end = ctx.Pipe()
+    farm = ctx.Process(target=_farm_process, args=(layout, port, args.slow_delay, child_end), daemon=True)
+    farm.start()
+    try:
+        if not ready.poll(30):
+            raise SystemExit("❌ 服务器群启动超时")
+        ready.recv()
+        counts = " / ".join(f"{kind} {mix.get(kind, 0)}" for kind in KINDS)
+        print(f"模拟 udpxy 服务器群: {SEGMENT_PREFIX}.0-{args.segments - 1}.x:{port} | {counts} | "
+              f"关闭 {args.segments * 254 - len(layout)} | 码率 {args.bitrates} Mbps")
+        asyncio.run(_run(args, layout, port))
+    finally:
+        farm.terminate()
+        farm.join()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -6,19 +6,26 @@
 # Author Leon<chenxin619315@gmail.com>
 
 import io
+import mmap
+import struct
+from array import array
+from bisect import bisect_right
 import ip2region.util as util
-from typing import Union
+from typing import Union, Iterable
 
 class Searcher(object):
     '''
     xdb searcher class with Both IPv4 and IPv6 supported.
-    three kinds of cache policy: file / vectorIndex / content
+    four kinds of cache policy: file / vectorIndex / content / mmap
     '''
     def __init__(self, version: util.Version, 
-                 db_path: str, vector_index: bytes, c_buffer: bytes):
+                 db_path: str, vector_index: bytes, c_buffer: bytes, mmap_obj: mmap.mmap = None):
         self.version = version
         self.__db_path = db_path
         self.__io_count = 0
+        # mmap policy: c_buffer is a memoryview over the mapping,
+        # so read() slices without any syscall or copy.
+        self.__mmap = mmap_obj
         if c_buffer != None:
             self.__handle = None
             self.vector_index = None
@@ -35,6 +42,35 @@ class Searcher(object):
         return self.__io_count
 
     def search(self, ip: Union[bytes, str]):
+        ip_bytes = self._check_ip(ip)
+
+        # reset the global io_count
+        self.__io_count = 0
+        return self._locate(ip_bytes)[1]
+
+    def search_many(self, ips: Iterable[Union[bytes, str]]):
+        '''
+        batch search, returns the region list in the input order.
+        the input is sorted first so that neighbouring ips sharing one
+        segment index entry resolve without another binary search,
+        and every region string is decoded only once.
+        '''
+        parsed = sorted((self._check_ip(ip), i) for i, ip in enumerate(ips))
+        results = [""] * len(parsed)
+        _bytes = self.version.byte_num
+        last_buff, last_region = None, ""
+        self.__io_count = 0
+        for ip_bytes, i in parsed:
+            if last_buff is not None \
+                    and self.version.ip_sub_compare(ip_bytes, last_buff, 0) >= 0 \
+                    and self.version.ip_sub_compare(ip_bytes, last_buff, _bytes) <= 0:
+                results[i] = last_region
+                continue
+            last_buff, last_region = self._locate(ip_bytes)
+            results[i] = last_region
+        return results
+
+    def _check_ip(self, ip: Union[bytes, str]):
         # check and parse the string ip
         ip_bytes = None
         if isinstance(ip, str):
@@ -48,10 +84,13 @@ class Searcher(object):
         if len(ip_bytes) != self.version.byte_num:
             raise ValueError("invalid ip address `{}` ({} expected)".format(
                 util.ip_to_string(ip_bytes), self.version.name))
+        return ip_bytes
 
-        # reset the global io_count
-        self.__io_count = 0
-
+    def _locate(self, ip_bytes: bytes):
+        '''
+        locate the segment index entry of the specified ip,
+        returns (index entry buffer or None, region string)
+        '''
         # located the segment index block based on the vector index
         s_ptr, e_ptr, i0, i1 = 0, 0, ip_bytes[0], ip_bytes[1]
         idx = i0 * util.VectorIndexCols * util.VectorIndexSize + i1 * util.VectorIndexSize
@@ -71,12 +110,13 @@ class Searcher(object):
         # @Note: ptr validate, zero ptr means source data missing
         # so we could just stop here and return an empty string.
         if s_ptr == 0 or e_ptr == 0:
-            return ""
+            return None, ""
 
         # binary search the segment index block to get the region info
         _bytes, _d_bytes = len(ip_bytes), len(ip_bytes) << 1
         index_size = self.version.index_size
         d_len, d_ptr, l, h = 0, 0, int(0), int((e_ptr - s_ptr) / index_size)
+        buff = None
         while l <= h:
             m = (l + h) >> 1
             p = int(s_ptr + m * index_size)
@@ -96,10 +136,11 @@ class Searcher(object):
         # empty match interception.
         # and this could be a case.
         if d_len == 0:
-            return ""
+            return None, ""
 
         # read and return the region info
-        return self.read(d_ptr, d_len).decode("utf-8")
+        # (str() decodes bytes and the mmap memoryview alike)
+        return buff, str(self.read(d_ptr, d_len), "utf-8")
 
     def read(self, offset: int, length: int):
         # check the content buffer first
@@ -114,6 +155,12 @@ class Searcher(object):
     def close(self):
         if self.__handle != None:
             self.__handle.close()
+        if self.__mmap != None:
+            # the memoryview must be released before the mapping can be closed
+            self.c_buffer.release()
+            self.c_buffer = None
+            self.__mmap.close()
+            self.__mmap = None
 
     def __str__(self):
         return '{{"version": {}, "db_path": "{}", "v_index": {}, "c_buffer": {}}}'.format(
@@ -124,6 +171,68 @@ class Searcher(object):
         )
 
 
+class IndexedSearcher(Searcher):
+    '''
+    IPv4 searcher over a content buffer (bytes or mmap memoryview).
+    each segment index block addressed by the vector index is decoded
+    once into unsigned int arrays, then located with bisect over plain
+    integers instead of per-byte comparisons. results are identical to
+    the Searcher binary search.
+    '''
+    def __init__(self, version: util.Version,
+                 db_path: str, c_buffer: bytes, mmap_obj: mmap.mmap = None):
+        super().__init__(version, db_path, None, c_buffer, mmap_obj)
+        self.__blocks = {}
+        self.__regions = {}
+
+    def _locate(self, ip_bytes: bytes):
+        if self.version is not util.IPv4 or self.c_buffer is None:
+            return super()._locate(ip_bytes)
+
+        key = (ip_bytes[0] << 8) | ip_bytes[1]
+        block = self.__blocks.get(key)
+        if block is None:
+            block = self.__blocks[key] = self.__decode_block(key)
+        s_ptr, starts, ends, d_lens, d_ptrs = block
+        if s_ptr == 0:
+            return None, ""
+
+        ip = int.from_bytes(ip_bytes, "big")
+        i = bisect_right(starts, ip) - 1
+        if i < 0 or ip > ends[i] or d_lens[i] == 0:
+            return None, ""
+
+        d_ptr = d_ptrs[i]
+        region = self.__regions.get(d_ptr)
+        if region is None:
+            region = self.__regions[d_ptr] = str(self.read(d_ptr, d_lens[i]), "utf-8")
+        index_size = self.version.index_size
+        return self.read(s_ptr + i * index_size, index_size), region
+
+    def search_many(self, ips: Iterable[Union[bytes, str]]):
+        # blocks are decoded once and bisect is cheap, no need to sort
+        if self.version is not util.IPv4 or self.c_buffer is None:
+            return super().search_many(ips)
+        return [self._locate(self._check_ip(ip))[1] for ip in ips]
+
+    def __decode_block(self, key: int):
+        offset = util.HeaderInfoLength + key * util.VectorIndexSize
+        s_ptr = util.le_get_uint32(self.c_buffer, offset)
+        e_ptr = util.le_get_uint32(self.c_buffer, offset + 4)
+        starts, ends, d_lens, d_ptrs = array("I"), array("I"), array("H"), array("I")
+        # @Note: same zero ptr rule as the binary search, source data missing
+        if s_ptr == 0 or e_ptr == 0:
+            return 0, starts, ends, d_lens, d_ptrs
+
+        # index entry: start ip (4) | end ip (4) | data len (2) | data ptr (4), little endian
+        for sip, eip, d_len, d_ptr in struct.iter_unpack("<IIHI", self.c_buffer[s_ptr:e_ptr + self.version.index_size]):
+            starts.append(sip)
+            ends.append(eip)
+            d_lens.append(d_len)
+            d_ptrs.append(d_ptr)
+        return s_ptr, starts, ends, d_lens, d_ptrs
+
+
 # ---
 # functions to create Searcher with different cache policy
 
@@ -135,3 +244,18 @@ def new_with_vector_index(version: util.Version, db_path: str, vector_index: byt
 
 def new_with_buffer(version: util.Version, c_buffer: bytes):
     return Searcher(version, None, None, c_buffer)
+
+def new_with_mmap(version: util.Version, db_path: str, indexed: bool = False):
+    '''
+    map the whole xdb file read-only, the pages are shared with the
+    os page cache and every read is a zero-copy memoryview slice.
+    indexed=True returns an IndexedSearcher (bisect over decoded blocks).
+    '''
+    with io.open(db_path, "rb") as handle:
+        mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    if indexed:
+        return IndexedSearcher(version, db_path, memoryview(mm), mm)
+    return Searcher(version, db_path, None, memoryview(mm), mm)
+
+def new_with_indexed_buffer(version: util.Version, c_buffer: bytes):
+    return IndexedSearcher(version, None, c_buffer)
@@ -83,7 +83,8 @@ def ip_compare(ip1: bytes, ip2: bytes):
         return 0
 
 def ip_sub_compare(ip1: bytes, buff: bytes, offset: int):
-    ip2 = buff[offset:offset+len(ip1)]
+    # bytes() keeps memoryview (mmap) buffers comparable, no copy for bytes input
+    ip2 = bytes(buff[offset:offset+len(ip1)])
     if ip1 > ip2:
         return 1
     elif ip1 < ip2:
@@ -1,23 +1,24 @@
-import os, re, time, threading, io, asyncio, concurrent.futures, json
+import os, re, time, threading, asyncio, contextlib, concurrent.futures, multiprocessing, json, socket, argparse, struct, mmap, zlib
 from datetime import datetime
 from collections import Counter
+from functools import lru_cache
 import httpx
 import ip2region.util as ip2region_util
 import ip2region.searcher as ip2region_searcher
-from utils import live_print, write_summary, log_section, atomic_write, parse_rtp_entries, build_m3u, build_compat
+from utils import (live_print, live_progress, reset_progress, flush_logs, LOG_DETAIL, LOG_WARN, write_summary, log_section, atomic_write,
+                   parse_rtp_entries, write_outputs, AdaptiveLimiter, TIMEOUT_SLACK, LoopMonitor, METRICS, timed, write_metrics)
 
 # --- 初始化离线 IP 归属地查询（ip2region xdb，零网络延迟） ---
+IP2REGION_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "ip2region.xdb")
 _ip2region_searcher = None
 def _get_ip2region():
     global _ip2region_searcher
     if _ip2region_searcher is None:
-        db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "ip2region.xdb")
-        handle = io.open(db_path, "rb")
-        header = ip2region_util.load_header(handle)
+        header = ip2region_util.load_header_from_file(IP2REGION_DB)
         version = ip2region_util.version_from_header(header)
-        v_index = ip2region_util.load_vector_index(handle)
-        _ip2region_searcher = ip2region_searcher.new_with_vector_index(version, db_path, v_index)
-        handle.close()
+        # mmap 整库：查询时按 memoryview 切片，无 seek/read 系统调用、无拷贝；
+        # indexed：段索引块首次命中时解码为整数数组，之后 bisect 定位，免逐字节比较
+        _ip2region_searcher = ip2region_searcher.new_with_mmap(version, IP2REGION_DB, indexed=True)
     return _ip2region_searcher
 
 # ===============================
@@ -45,8 +46,10 @@ BLACKLIST_FILE = "data/blacklist.txt"
 RTP_FILE = "data/rtp/ChinaTelecom-Guangdong.txt"
 
 SOURCE_IP_FILE = "output/source-ip.txt"
-SOURCE_M3U_FILE = "output/source-m3u.txt"
-SOURCE_NONCHECK_FILE = "output/source-m3u-noncheck.txt"
+SOURCE_NONCHECK_FILE = "output/source-m3u-noncheck.txt"  # 未测速全量；source-m3u.txt 由 probe.py 测速后写出
+SOURCE_COMPACT_FILE = "output/source-m3u-noncheck.compact.json"  # 频道模板 + 服务器列表，下游自行展开
+OUTPUT_MANIFEST = "output/manifest.json"  # 各输出文件的内容哈希，未变则不改写
+HANDOFF_FILE = "output/source-handoff.json"  # 交给 probe.py 的结构化清单（免解析全量链接文件）
 
 DEFAULT_PORTS = [4022, 8000, 8686, 55555, 54321, 1024, 10001, 8443, 8888]
 
@@ -61,28 +64,164 @@ DEFAULT_PORT_MISSES_EXTRA = 3  # 默认端口额外容忍次数
 # 核心功能函数
 # ===============================
 
+@lru_cache(maxsize=4096)
+def _region_verdict(region):
+    """解析 ip2region 区域串，返回 (是否广东电信, 描述)。按原始区域串 LRU 缓存（区域串种类远少于 IP 数）"""
+    if not region:
+        return False, "无归属数据"
+    # ip2region v3 返回格式: "国家|省份|城市|ISP|iso-alpha2-Code"
+    parts = region.split("|")
+    province = parts[1] if len(parts) > 1 else "未知"
+    city = parts[2] if len(parts) > 2 else "未知"
+    isp = parts[3].lower() if len(parts) > 3 and parts[3] else "未知"
+    is_gd = "广东" in province
+    is_tel = any(k in isp for k in ["电信", "telecom", "chinanet"])
+    isp_display = parts[3] if len(parts) > 3 and parts[3] else "未知"
+    desc = f"{province}-{city} | {isp_display}"
+    return (is_gd and is_tel), desc
+
 def get_geo_info(ip):
     """查询 IP 归属地（离线 ip2region，零延迟无限速）"""
     try:
-        region = _get_ip2region().search(ip)
-        if not region:
-            return False, "无归属数据"
-        # ip2region v3 返回格式: "国家|省份|城市|ISP|iso-alpha2-Code"
-        parts = region.split("|")
-        province = parts[1] if len(parts) > 1 else "未知"
-        city = parts[2] if len(parts) > 2 else "未知"
-        isp = parts[3].lower() if len(parts) > 3 and parts[3] else "未知"
-        is_gd = "广东" in province
-        is_tel = any(k in isp for k in ["电信", "telecom", "chinanet"])
-        isp_display = parts[3] if len(parts) > 3 and parts[3] else "未知"
-        desc = f"{province}-{city} | {isp_display}"
-        return (is_gd and is_tel), desc
+        return _region_verdict(_get_ip2region().search(ip))
     except Exception as e:
         return False, f"查询异常: {e}"
 
+def get_geo_info_many(ips):
+    """批量查询归属地：排序后一次遍历索引（search_many），返回与输入同序的 [(是否广东电信, 描述), ...]"""
+    try:
+        return [_region_verdict(region) for region in _get_ip2region().search_many(ips)]
+    except Exception:
+        # 批量失败（如个别脏 IP）时逐个查询，保证单个异常不影响整批
+        return [get_geo_info(ip) for ip in ips]
+
+def geo_cache_summary():
+    """区域串解析缓存命中统计（单行），供阶段摘要展示"""
+    region = _region_verdict.cache_info()
+    return f"区域串 {region.hits}/{region.hits + region.misses} 命中 ({region.currsize} 种)"
+
 SAMPLE_IPS_PER_SEG = [1, 100, 200]  # 每个C段抽测3个IP
 SAMPLE_GEO_THRESHOLD = 2              # 至少2个IP不合格才跳过（容忍1个误报）
 
+# ===============================
+# 1b. /24 归属地预编译表（按 xdb createdAt 缓存，mmap 加载，O(1) 查询）
+# ===============================
+# 文件格式: 16 字节头（b"GV24" | u16 版本 | u16 保留 | u32 xdb createdAt | u32 抽样规则签名）
+#          + 2^24 bit 段判定位图（按 SAMPLE_IPS_PER_SEG / SAMPLE_GEO_THRESHOLD 规则是否通过）
+#          + 2^24 bit 混合位图（该 /24 内既有合格又有不合格地址，单 IP 复核需回退到逐个查询）
+GEO_TABLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "geo-verdict.bin")
+GEO_TABLE_MAGIC = b"GV24"
+GEO_TABLE_VERSION = 1
+GEO_TABLE_HEADER = struct.Struct("<4sHHII")
+GEO_BITMAP_BYTES = (1 << 24) >> 3
+
+_geo_table = None
+
+
+def _geo_rule_signature():
+    """抽样规则签名：抽样点或阈值变化时预编译表自动失效"""
+    return zlib.crc32(json.dumps([SAMPLE_IPS_PER_SEG, SAMPLE_GEO_THRESHOLD]).encode())
+
+
+def _set_bit_range(buf, lo, hi):
+    """将位图 [lo, hi) 区间置 1（整字节部分用切片赋值）"""
+    while lo < hi and lo & 7:
+        buf[lo >> 3] |= 1 << (lo & 7); lo += 1
+    while lo < hi and hi & 7:
+        hi -= 1; buf[hi >> 3] |= 1 << (hi & 7)
+    if lo < hi:
+        buf[lo >> 3:hi >> 3] = b"\xff" * ((hi - lo) >> 3)
+
+
+def build_geo_table(created_at):
+    """遍历一次 xdb 段索引，编译每个 /24 的段判定与混合标记，原子写入 GEO_TABLE_FILE。
+
+    整段覆盖的 /24 直接按位区间置位；只有被多个索引项切分的边缘 /24 才逐个统计抽样点。
+    """
+    searcher = _get_ip2region()
+    if searcher.get_ip_version() is not ip2region_util.IPv4:
+        raise ValueError("预编译表仅支持 IPv4 xdb")
+    header = ip2region_util.load_header_from_file(IP2REGION_DB)
+    buf = searcher.c_buffer
+    index_size = searcher.version.index_size
+    seg_pass, mixed = bytearray(GEO_BITMAP_BYTES), bytearray(GEO_BITMAP_BYTES)
+    need = len(SAMPLE_IPS_PER_SEG) - SAMPLE_GEO_THRESHOLD + 1  # 至少这么多抽样点合格才通过
+    region_ok = {}
+    partial = {}  # /24 → [合格抽样点数, 见过合格, 见过不合格]
+
+    def _edge(c, lo, hi, ok):
+        st = partial.setdefault(c, [0, False, False])
+        if ok:
+            st[0] += sum(1 for o in SAMPLE_IPS_PER_SEG if lo <= o <= hi)
+            st[1] = True
+        else:
+            st[2] = True
+
+    for sip, eip, d_len, d_ptr in struct.iter_unpack("<IIHI", buf[header.startIndexPtr:header.endIndexPtr + index_size]):
+        ok = region_ok.get(d_ptr)
+        if ok is None:
+            ok = region_ok[d_ptr] = d_len > 0 and _region_verdict(str(buf[d_ptr:d_ptr + d_len], "utf-8"))[0]
+        c0, c1 = sip >> 8, eip >> 8
+        if c0 == c1 and (sip & 0xFF or eip & 0xFF != 0xFF):
+            _edge(c0, sip & 0xFF, eip & 0xFF, ok)
+            continue
+        lo, hi = c0, c1 + 1
+        if sip & 0xFF:
+            _edge(c0, sip & 0xFF, 0xFF, ok); lo += 1
+        if eip & 0xFF != 0xFF:
+            _edge(c1, 0, eip & 0xFF, ok); hi -= 1
+        if ok and lo < hi:
+            _set_bit_range(seg_pass, lo, hi)
+
+    for c, (n_ok, seen_ok, seen_fail) in partial.items():
+        if n_ok >= need:
+            seg_pass[c >> 3] |= 1 << (c & 7)
+        if seen_ok and seen_fail:
+            mixed[c >> 3] |= 1 << (c & 7)
+
+    head = GEO_TABLE_HEADER.pack(GEO_TABLE_MAGIC, GEO_TABLE_VERSION, 0, created_at, _geo_rule_signature())
+    tmp = GEO_TABLE_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(head); f.write(seg_pass); f.write(mixed)
+    os.replace(tmp, GEO_TABLE_FILE)
+
+
+def _get_geo_table():
+    """加载 /24 预编译表（mmap）；xdb createdAt 或抽样规则变化时先重新编译。xdb 缺失或编译失败返回 None"""
+    global _geo_table
+    if _geo_table is not None:
+        return _geo_table or None
+    _geo_table = False
+    try:
+        created_at = ip2region_util.load_header_from_file(IP2REGION_DB).createdAt
+        expected = (GEO_TABLE_MAGIC, GEO_TABLE_VERSION, 0, created_at, _geo_rule_signature())
+        current = None
+        if os.path.exists(GEO_TABLE_FILE):
+            with open(GEO_TABLE_FILE, "rb") as f:
+                raw = f.read(GEO_TABLE_HEADER.size)
+            if len(raw) == GEO_TABLE_HEADER.size:
+                current = GEO_TABLE_HEADER.unpack(raw)
+        if current != expected:
+            t0 = time.time()
+            build_geo_table(created_at)
+            live_print(f"🧱 /24 归属地预编译表已重建 (xdb createdAt={created_at}, 耗时 {time.time() - t0:.2f}s)")
+        with open(GEO_TABLE_FILE, "rb") as f:
+            _geo_table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, struct.error) as e:
+        live_print(f"⚠️ /24 预编译表不可用，回退逐 IP 查询: {e}", LOG_WARN)
+    return _geo_table or None
+
+
+def _geo_table_bits(table, ip):
+    """返回 (段判定是否通过, 该 /24 是否混合)；ip 为 'a.b.c' 段或 'a.b.c.d' 地址"""
+    a, b, c = ip.split(".")[:3]
+    idx = (int(a) << 16) | (int(b) << 8) | int(c)
+    byte, mask = idx >> 3, 1 << (idx & 7)
+    base = GEO_TABLE_HEADER.size
+    return bool(table[base + byte] & mask), bool(table[base + GEO_BITMAP_BYTES + byte] & mask)
+
+
+@timed("phase.filter_segments")
 def filter_segments(segments):
     """C段 预校验与清洗（多IP抽样，防止 .1 网关误判）。
     
@@ -101,15 +240,34 @@ def filter_segments(segments):
     blacklist_skip = 0
     live_print(f"📋 待检测: {total} 个 | 黑名单库: {len(blacklist)} 个 | 抽样: {len(SAMPLE_IPS_PER_SEG)} 个IP/段")
 
+    table = _get_geo_table()
+    if table is not None:
+        # 预编译表：每段一次位图查询，判定规则与下方逐 IP 抽样一致
+        for idx, seg in enumerate(segments, 1):
+            if seg in blacklist:
+                blacklist_skip += 1
+                continue
+            if _geo_table_bits(table, seg)[0]:
+                valid_segments.append(seg)
+                live_print(f"  [{idx}/{total}] ✅ 通过: {seg} (预编译表)", LOG_DETAIL)
+            else:
+                skipped_segments.append(seg)
+                live_print(f"  [{idx}/{total}] ❌ 跳过: {seg} (预编译表)", LOG_DETAIL)
+        live_print(f"📊 最终有效 C段: {len(valid_segments)} 个 (历史黑名单跳过: {blacklist_skip} 个, 本次临时跳过: {len(skipped_segments)} 个)")
+        return valid_segments, blacklist_skip
+
+    # 多IP抽样（.1/.100/.200），防止网关IP误判；所有段的抽样 IP 一次批量查询
+    sample_ips = [f"{seg}.{offset}" for seg in segments if seg not in blacklist for offset in SAMPLE_IPS_PER_SEG]
+    verdicts = dict(zip(sample_ips, get_geo_info_many(sample_ips)))
+
     for idx, seg in enumerate(segments, 1):
         if seg in blacklist:
             blacklist_skip += 1
             continue
-        # 多IP抽样（.1/.100/.200），防止网关IP误判
         sample_details = []
         for offset in SAMPLE_IPS_PER_SEG:
             ip = f"{seg}.{offset}"
-            is_valid, desc = get_geo_info(ip)
+            is_valid, desc = verdicts[ip]
             sample_details.append((ip, is_valid, desc))
 
         # 统计不合格IP数，并构造详细日志
@@ -119,16 +277,16 @@ def filter_segments(segments):
         
         if fail_count >= SAMPLE_GEO_THRESHOLD:
             # 至少2个IP不合格才跳过（容忍1个误报）
-            live_print(f"  [{idx}/{total}] ❌ 跳过: {seg}")
+            live_print(f"  [{idx}/{total}] ❌ 跳过: {seg}", LOG_DETAIL)
             for line in detail_lines:
-                live_print(f"      {line}")
+                live_print(f"      {line}", LOG_DETAIL)
             skipped_segments.append(seg)
         else:
             # 至少1个IP合格即通过
             valid_segments.append(seg)
-            live_print(f"  [{idx}/{total}] ✅ 通过: {seg} ({ok_count}/{len(SAMPLE_IPS_PER_SEG)} 合格)")
+            live_print(f"  [{idx}/{total}] ✅ 通过: {seg} ({ok_count}/{len(SAMPLE_IPS_PER_SEG)} 合格)", LOG_DETAIL)
             for line in detail_lines:
-                live_print(f"      {line}")
+                live_print(f"      {line}", LOG_DETAIL)
 
     live_print(f"📊 最终有效 C段: {len(valid_segments)} 个 (历史黑名单跳过: {blacklist_skip} 个, 本次临时跳过: {len(skipped_segments)} 个)")
     
@@ -301,6 +459,147 @@ def _update_port_stats_after_scan(stats, scanned_ports, source_ip_file):
     return deactivated
 
 
+# ===============================
+# 2c. 主机存活历史（按 /24 记录历史存活主机，决定扫描顺序与抽样）
+# ===============================
+HOST_HISTORY_FILE = "data/host-history.json"
+
+HISTORY_DEAD_RUNS = int(os.environ.get("HISTORY_DEAD_RUNS", "8"))        # C段连续多少次零命中后改为抽样扫描
+HISTORY_SAMPLE_EVERY = int(os.environ.get("HISTORY_SAMPLE_EVERY", "4"))  # 抽样比例：每轮扫 1/N 主机，N 轮轮转覆盖整段
+HISTORY_FORGET_MISSES = 30                                                # 主机连续未命中超过此次数则从历史中移除
+
+
+def _load_host_history():
+    """加载主机存活历史：{"segments": {seg: {"dead_runs": n, "hosts": {"末位": [最近存活时间戳, 最近端口, 连续未命中]}}}}"""
+    if os.path.exists(HOST_HISTORY_FILE):
+        try:
+            with open(HOST_HISTORY_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError):
+            pass
+    return {"version": 1, "run_counter": 0, "segments": {}}
+
+
+def _save_host_history(history):
+    """保存主机存活历史（一段一行，便于 git diff 只反映变动的 C段）"""
+    body = ",\n".join(f"{json.dumps(seg)}: {json.dumps(entry, separators=(',', ':'))}"
+                      for seg, entry in sorted(history["segments"].items()))
+    atomic_write(HOST_HISTORY_FILE,
+                 f'{{"version": {history.get("version", 1)}, "run_counter": {history.get("run_counter", 0)}, '
+                 f'"segments": {{\n{body}\n}}}}\n')
+
+
+def _sampled_segments(segments, history):
+    """长期零命中（dead_runs ≥ HISTORY_DEAD_RUNS）、本轮只做抽样扫描的 C段 集合"""
+    if HISTORY_SAMPLE_EVERY <= 1:
+        return set()
+    seg_history = (history or {}).get("segments", {})
+    return {seg for seg in segments if seg_history.get(seg, {}).get("dead_runs", 0) >= HISTORY_DEAD_RUNS}
+
+
+def _scan_plan(segments, history, sample=True):
+    """按历史生成扫描计划。
+
+    返回 (hot, cold, sampled)：
+    - hot: [(ip, 最近端口), ...] 历史存活主机，按连续未命中升序、最近存活降序，全局优先扫描
+    - cold: [(seg, [主机末位, ...]), ...] 其余主机；长期零命中的 C段 只取轮转抽样的 1/HISTORY_SAMPLE_EVERY
+    - sampled: 本轮被抽样（非全量）的 C段 集合；sample=False 时不抽样（增量模式下选中的段必须全扫）
+    """
+    seg_history = (history or {}).get("segments", {})
+    run_counter = (history or {}).get("run_counter", 0)
+    sampled = _sampled_segments(segments, history) if sample else set()
+    hot, cold = [], []
+    for seg in segments:
+        known = seg_history.get(seg, {}).get("hosts", {})
+        for host, (last_seen, last_port, misses) in known.items():
+            hot.append((misses, -last_seen, f"{seg}.{host}", last_port))
+        rest = [i for i in range(1, 255) if str(i) not in known]
+        if seg in sampled:
+            rest = [i for i in rest if (i + run_counter) % HISTORY_SAMPLE_EVERY == 0]
+        cold.append((seg, rest))
+    hot.sort()
+    return [(ip, port) for _, _, ip, port in hot], cold, sampled
+
+
+def _update_host_history(history, segments, alive_ips, sampled=()):
+    """扫描后更新主机历史：命中主机刷新时间与端口，未命中主机累加 misses，C段 记录连续零命中次数。
+
+    同时维护增量模式所需的段级字段：last_full（最近一次全量扫描时间，抽样段不计）、hits（累计命中）、last_hit。
+    """
+    now = int(time.time())
+    hits = {}
+    for ip_port in alive_ips:
+        ip, port = ip_port.rsplit(":", 1)
+        seg, host = ip.rsplit(".", 1)
+        hits.setdefault(seg, {})[host] = int(port)
+
+    seg_history = history.setdefault("segments", {})
+    for seg in segments:
+        entry = seg_history.setdefault(seg, {"dead_runs": 0, "hosts": {}})
+        seg_hits = hits.get(seg, {})
+        hosts = entry["hosts"]
+        for host in list(hosts):
+            if host not in seg_hits:
+                hosts[host][2] += 1
+                if hosts[host][2] > HISTORY_FORGET_MISSES:
+                    del hosts[host]
+        for host, port in seg_hits.items():
+            hosts[host] = [now, port, 0]
+        entry["dead_runs"] = 0 if seg_hits else entry.get("dead_runs", 0) + 1
+        entry["hits"] = entry.get("hits", 0) + len(seg_hits)
+        if seg_hits:
+            entry["last_hit"] = now
+        if seg not in sampled:
+            entry["last_full"] = now
+    history["run_counter"] = history.get("run_counter", 0) + 1
+
+
+# ===============================
+# 2d. 增量扫描模式（只全扫新段 / 热段 / 到期段 + 轮转切片）
+# ===============================
+# full = 每轮全扫所有有效 C段（默认）；delta = 增量模式，已知存活主机由 source-ip.txt 增量验证兜底
+SCAN_MODE = os.environ.get("SCAN_MODE", "full").strip().lower()
+DELTA_WINDOW_HOURS = float(os.environ.get("DELTA_WINDOW_HOURS", "24"))      # 每个 C段 至少每隔这么久全扫一次
+DELTA_RUN_INTERVAL_HOURS = float(os.environ.get("DELTA_RUN_INTERVAL_HOURS", "3"))  # 调度间隔（与 cron 一致）
+DELTA_HOT_HOURS = float(os.environ.get("DELTA_HOT_HOURS", "24"))            # 最近这么久内有命中的段视为热段
+
+
+def _select_delta_segments(segments, history):
+    """增量模式选段：新段 + 热段 + 到期段（距上次全扫 ≥ 窗口 - 调度间隔，保证窗口内必扫）+ 其余段中最久未扫的轮转切片。
+
+    返回 (selected, reasons)，reasons 为 {"new": n, "hot": n, "due": n, "rotate": n}。
+    """
+    now = time.time()
+    window, interval = DELTA_WINDOW_HOURS * 3600, DELTA_RUN_INTERVAL_HOURS * 3600
+    seg_history = history.get("segments", {})
+    reasons = {"new": 0, "hot": 0, "due": 0, "rotate": 0}
+    selected, rest = [], []
+    for seg in segments:
+        entry = seg_history.get(seg, {})
+        last_full = entry.get("last_full")
+        if last_full is None:
+            reasons["new"] += 1
+        elif now - entry.get("last_hit", 0) <= DELTA_HOT_HOURS * 3600:
+            reasons["hot"] += 1
+        elif now - last_full >= window - interval:
+            reasons["due"] += 1
+        else:
+            rest.append((last_full, seg))
+            continue
+        selected.append(seg)
+
+    # 轮转切片：每轮扫 interval/window 比例的剩余段（最久未扫优先），整体在窗口内均摊
+    if rest and window > 0:
+        rest.sort()
+        quota = min(len(rest), -(-len(rest) * interval // window))
+        chosen = {seg for _, seg in rest[:int(quota)]}
+        reasons["rotate"] = len(chosen)
+        selected.extend(seg for _, seg in rest if seg in chosen)
+    order = {seg: i for i, seg in enumerate(segments)}
+    selected.sort(key=order.get)
+    return selected, reasons
+
+
 def update_discovery_database(new_ips):
     """更新发现库"""
     log_section("📂 更新发现库 (data/discovery.txt)", "🔹")
@@ -345,6 +644,14 @@ INCR_CONNECT_TIMEOUT = 0.3
 INCR_READ_TIMEOUT = 0.5
 
 
+def new_scan_client():
+    """扫描用 httpx 客户端（短超时、独立连接池；run.py 中与测速 client 分开，互不挤占）"""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=200, max_connections=1000),
+        timeout=httpx.Timeout(connect=SCAN_CONNECT_TIMEOUT, read=SCAN_READ_TIMEOUT, write=1.5, pool=0.5),
+    )
+
+
 async def check_udpxy(ip_port, found_set=None, timeout=None, client=None):
     """HTTP 指纹探测（两阶段超时：connect快筛 + read给足时间）。
 
@@ -381,33 +688,169 @@ async def check_udpxy(ip_port, found_set=None, timeout=None, client=None):
             await client.aclose()
     return False, None
 
-async def run_native_scan(segments, ports, found_set=None):
-    """统一扫描：持续任务流，结果随到随处理，不等慢任务 (async + httpx)"""
+# 扫描引擎选择：httpx（默认，完整 HTTP 客户端）/ raw（asyncio streams 精简指纹探测）
+SCAN_ENGINE = os.environ.get("SCAN_ENGINE", "httpx").strip().lower()
+SCAN_ENGINES = ("httpx", "raw")
+if SCAN_ENGINE not in SCAN_ENGINES:
+    live_print(f"⚠️ 未知 SCAN_ENGINE={SCAN_ENGINE!r}（可选 {'/'.join(SCAN_ENGINES)}），使用 httpx", LOG_WARN)
+    SCAN_ENGINE = "httpx"
+
+# raw 引擎：预编码请求 + 只读前几 KB，按字节匹配指纹
+RAW_STATUS_REQUEST = b"GET /status HTTP/1.0\r\nUser-Agent: Wget/1.14\r\nAccept: */*\r\nConnection: close\r\n\r\n"
+RAW_READ_LIMIT = 4096
+RAW_FINGERPRINT = b"udpxy"
+
+
+async def check_udpxy_raw(ip_port, found_set=None, timeout=None):
+    """raw 指纹探测（asyncio.open_connection，免 httpx 请求构建/头解析/文本解码）。
+
+    与 check_udpxy 判定一致：状态行 200 且响应体（不含响应头）包含 udpxy。
+    timeout 语义同 check_udpxy：None → SCAN_* 默认；(connect, read) 元组 → 自定义。
+    """
+    ip = ip_port.split(":")[0]
+    if found_set is not None and ip in found_set: return False, None
+
+    if timeout is None:
+        connect_to, read_to = SCAN_CONNECT_TIMEOUT, SCAN_READ_TIMEOUT
+    elif isinstance(timeout, tuple):
+        connect_to, read_to = timeout
+    else:
+        connect_to = read_to = timeout
+
+    host, port = ip_port.rsplit(":", 1)
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), connect_to)
+        writer.write(RAW_STATUS_REQUEST)
+        buf = b""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + read_to
+        while len(buf) < RAW_READ_LIMIT:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            chunk = await asyncio.wait_for(reader.read(RAW_READ_LIMIT - len(buf)), remaining)
+            if not chunk:
+                break
+            buf += chunk
+            head_end = buf.find(b"\r\n\r\n")
+            if head_end != -1 and RAW_FINGERPRINT in buf[head_end + 4:].lower():
+                break
+        head_end = buf.find(b"\r\n\r\n")
+        status_line = buf.split(b"\r\n", 1)[0].split()
+        if (head_end != -1 and len(status_line) >= 2 and status_line[1] == b"200"
+                and RAW_FINGERPRINT in buf[head_end + 4:].lower()):
+            if found_set is not None:
+                found_set.add(ip)
+            return True, ip_port
+    except Exception:
+        pass
+    finally:
+        if writer is not None:
+            writer.close()
+            # 等待传输层真正关闭，避免高并发下遗留半关闭的连接
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+    return False, None
+
+# 两阶段扫描：先做纯 TCP connect 快筛（不发请求、不等读），只有接受连接的 ip:port 才进入 HTTP 指纹阶段。
+# 绝大多数目标根本完不成握手，快筛阶段可开更高并发，指纹阶段的 read 超时槽位只留给开放端口。
+SCAN_PREPASS = os.environ.get("SCAN_PREPASS", "1") != "0"
+SWEEP_WORKERS = int(os.environ.get("SWEEP_WORKERS", "2000"))
+
+
+async def tcp_connect_probe(ip_port, timeout=None):
+    """纯 connect 探测：非阻塞 socket + sock_connect，握手成功即关闭。返回 (is_open, ip_port)"""
+    host, port = ip_port.rsplit(":", 1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, (host, int(port))),
+                               SCAN_CONNECT_TIMEOUT if timeout is None else timeout)
+        return True, ip_port
+    except (OSError, asyncio.TimeoutError):
+        return False, ip_port
+    finally:
+        sock.close()
+
+@timed("phase.scan")
+async def run_native_scan(segments, ports, found_set=None, stats=None, verify_known=True, verify_only=False,
+                          history=None, sample=True, client=None, on_hit=None):
+    """统一扫描：持续任务流，结果随到随处理，不等慢任务 (async + httpx)。
+
+    stats 为 dict 时写入并发窗口摘要（stats["concurrency"]）与完成任务数（stats["scan_completed"]），供阶段摘要展示。
+    verify_known=False 跳过 source-ip.txt 增量验证（分片子进程由父进程统一验证）；
+    verify_only=True 只做增量验证不做全量扫描。
+    history 为 _load_host_history() 的返回值时，按主机存活历史排序/抽样扫描目标（sample=False 不抽样）。
+    client 为外部传入的 httpx.AsyncClient 时复用（不关闭），否则用 new_scan_client() 自建。
+    on_hit(ip_port) 在每次确认命中时同步回调（run.py 借此在扫描进行中提前测速）。
+    """
     log_section("🚀 启动扫描 (async + 持续任务流)", "🔹")
-    if not segments:
-        live_print("⚠️ 无有效网段"); return []
+    if not segments and not verify_only:
+        live_print("⚠️ 无有效网段"); return [], 0
 
     scan_workers = int(os.environ.get("SCAN_WORKERS", "500"))
 
     # 复用外部 found_set（跨扫描共享，IP 命中后跳过其他端口）
     if found_set is None:
         found_set = set()
-    sem = asyncio.Semaphore(scan_workers)
+    # 自适应并发窗口：SCAN_WORKERS 为初始值，SCAN_WORKERS_MAX 为上限（默认 4 倍）
+    scan_ctl = AdaptiveLimiter("scan", scan_workers,
+                               maximum=int(os.environ.get("SCAN_WORKERS_MAX", scan_workers * 4)),
+                               timeout_hint=SCAN_CONNECT_TIMEOUT)
+    sweep_ctl = AdaptiveLimiter("sweep", SWEEP_WORKERS,
+                                maximum=int(os.environ.get("SWEEP_WORKERS_MAX", SWEEP_WORKERS * 4)),
+                                timeout_hint=SCAN_CONNECT_TIMEOUT)
+
+    # LOOP_MONITOR=1 时采样事件循环延迟 / 在途任务 / 窗口等待 / asyncio.wait 记账开销
+    monitor = LoopMonitor("scan", [scan_ctl, sweep_ctl])
 
     # 端口优先级：高频端口排前面，更快命中
     port_list = [int(p) for p in ports]
 
     async def check_one(ip_port, timeout, client):
-        async with sem:
-            return await check_udpxy(ip_port, found_set, timeout, client)
+        async with scan_ctl:
+            t0 = time.monotonic()
+            if SCAN_ENGINE == "raw":
+                res = await check_udpxy_raw(ip_port, found_set, timeout)
+            else:
+                res = await check_udpxy(ip_port, found_set, timeout, client)
+            elapsed = time.monotonic() - t0
+            # 只有失败且耗时触及 connect 超时才算超时：高 RTT 链路上成功的指纹探测不应让窗口收缩
+            connect_timeout = SCAN_CONNECT_TIMEOUT if timeout is None else timeout[0]
+            timed_out = not res[0] and elapsed >= connect_timeout * TIMEOUT_SLACK
+            scan_ctl.record(elapsed, timed_out=timed_out)
+            METRICS.observe("scan.fingerprint_ms", elapsed * 1000)
+            if timed_out:
+                METRICS.incr("scan.timeouts")
+            return res
+
+    async def sweep_one(ip_port):
+        async with sweep_ctl:
+            t0 = time.monotonic()
+            res = await tcp_connect_probe(ip_port)
+            elapsed = time.monotonic() - t0
+            timed_out = not res[0] and elapsed >= SCAN_CONNECT_TIMEOUT * TIMEOUT_SLACK
+            sweep_ctl.record(elapsed, timed_out=timed_out)
+            METRICS.observe("sweep.connect_ms", elapsed * 1000)
+            if res[0]:
+                METRICS.incr("sweep.open")
+            elif timed_out:
+                METRICS.incr("sweep.timeouts")
+            return res
 
     alive_ips = []
-    async with httpx.AsyncClient(
-        limits=httpx.Limits(max_keepalive_connections=200, max_connections=1000),
-        timeout=httpx.Timeout(connect=SCAN_CONNECT_TIMEOUT, read=SCAN_READ_TIMEOUT, write=1.5, pool=0.5),
-    ) as client:
+
+    def _hit(matched):
+        alive_ips.append(matched)
+        METRICS.incr("scan.hits")
+        if on_hit is not None:
+            on_hit(matched)
+
+    async with (contextlib.nullcontext(client) if client is not None else new_scan_client()) as client:
+        monitor.start()
         # 增量验证：先快速验证上次的存活 IP（随完随处理）
-        if os.path.exists(SOURCE_IP_FILE):
+        if verify_known and os.path.exists(SOURCE_IP_FILE):
             with open(SOURCE_IP_FILE, "r", encoding="utf-8") as f:
                 known_alive = [line.strip() for line in f if line.strip()]
             if known_alive:
@@ -418,7 +861,7 @@ async def run_native_scan(segments, ports, found_set=None):
                     ok, matched = await coro
                     if ok and matched:
                         still_alive.append(matched)
-                        alive_ips.append(matched)
+                        _hit(matched)
                 live_print(f"✅ 已知存活验证: {len(still_alive)}/{len(known_alive)} 个")
                 removed = len(known_alive) - len(still_alive)
                 if removed > 0:
@@ -427,66 +870,236 @@ async def run_native_scan(segments, ports, found_set=None):
                     # 又是 event loop 内同步 I/O，且会产生裁剪版中间态。
                     live_print(f"🧹 清理 {removed} 个失效 IP (最终以阶段4归档为准)")
 
+        if verify_only:
+            scan_ctl.close()
+            sweep_ctl.close()
+            monitor.stop()
+            return list(set(alive_ips)), 0
+
         # 全量扫描：持续任务流，滚动窗口
+        # 历史存活主机（跨所有 C段）优先，且先试其最近命中端口；长期零命中 C段 轮转抽样
+        hot, cold, sampled = _scan_plan(segments, history, sample)
+        if hot or sampled:
+            live_print(f"🧠 主机历史: 优先扫描 {len(hot)} 个历史存活主机 | 抽样 C段 {len(sampled)} 个 (1/{HISTORY_SAMPLE_EVERY})")
+
         def _task_generator():
-            for seg in segments:
-                for i in range(1, 255):
+            for ip, last_port in hot:
+                if ip in found_set:
+                    continue
+                if last_port in port_list:
+                    yield f"{ip}:{last_port}"
+                for port in port_list:
+                    if port != last_port:
+                        yield f"{ip}:{port}"
+            for seg, hosts in cold:
+                for i in hosts:
                     ip = f"{seg}.{i}"
                     if ip in found_set:
                         continue
                     for port in port_list:
                         yield f"{ip}:{port}"
 
-        total_tasks = len(segments) * 254 * len(port_list)
-        live_print(f"🎯 全量扫描: 持续任务流 (并发: {scan_workers}, 预估任务: {total_tasks})")
+        total_tasks = (len(hot) + sum(len(hosts) for _, hosts in cold)) * len(port_list)
         task_gen = _task_generator()
         completed = 0
         start_time = time.time()
+        reset_progress("scan")
+
+        def _progress_text(extra=""):
+            elapsed = time.time() - start_time
+            rate = completed / elapsed if elapsed > 0 else 0
+            found = len(set(alive_ips))
+            msg = f" 📊 进度: {completed}/{total_tasks} | 发现: {found} | 命中IP: {len(found_set)}{extra}"
+            if rate > 0:
+                remaining = (total_tasks - completed) / rate
+                msg += f" | 速度: {rate:.0f}/s | 预估剩余: {remaining:.0f}s"
+            return msg
+
+        if SCAN_PREPASS:
+            # 两阶段：connect 快筛（高并发）→ 队列 → HTTP 指纹（仅开放端口）
+            live_print(f"🎯 全量扫描: 两阶段 (connect 并发: {SWEEP_WORKERS} → 指纹引擎: {SCAN_ENGINE}, 并发: {scan_workers}, 预估任务: {total_tasks})")
+            fp_workers = scan_ctl.maximum if scan_ctl.enabled else scan_workers
+            queue = asyncio.Queue(maxsize=fp_workers * 4)
+            open_count = 0
+
+            async def _sweep_stage():
+                nonlocal completed, open_count
+                pending = set()
+                while True:
+                    while len(pending) < sweep_ctl.limit:
+                        try:
+                            ip_port = next(task_gen)
+                        except StopIteration:
+                            break
+                        pending.add(asyncio.create_task(sweep_one(ip_port)))
+                    if not pending:
+                        break
+                    done, pending = await monitor.wait(pending)
+                    for task in done:
+                        completed += 1
+                        is_open, ip_port = task.result()
+                        # 同 IP 已在其他端口命中 → 不再进入指纹阶段
+                        if is_open and ip_port.split(":")[0] not in found_set:
+                            open_count += 1
+                            await queue.put(ip_port)
+                        # 按时间限频（LOG_PROGRESS_INTERVAL），不再按任务数取模
+                        live_progress("scan", lambda: _progress_text(f" | 开放端口: {open_count}"))
+                for _ in range(fp_workers):
+                    await queue.put(None)
+
+            async def _fingerprint_worker():
+                while True:
+                    ip_port = await queue.get()
+                    if ip_port is None:
+                        return
+                    ok, matched_ip = await check_one(ip_port, None, client)
+                    if ok and matched_ip:
+                        _hit(matched_ip)
+                        live_print(f"    🎯 命中: {matched_ip}", LOG_DETAIL)
+
+            await asyncio.gather(_sweep_stage(), *(_fingerprint_worker() for _ in range(fp_workers)))
+            live_print(f"   🔌 connect 快筛: {completed} 个 ip:port → 开放 {open_count} 个进入指纹阶段")
+        else:
+            live_print(f"🎯 全量扫描: 持续任务流 (引擎: {SCAN_ENGINE}, 并发: {scan_workers}, 预估任务: {total_tasks})")
 
-        # 初始化：启动 scan_workers 个任务
-        pending = set()
-        for _ in range(scan_workers):
-            try:
-                ip_port = next(task_gen)
-                pending.add(asyncio.create_task(check_one(ip_port, None, client)))
-            except StopIteration:
-                break
-
-        while pending:
-            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
-            for task in done:
-                completed += 1
-                ok, matched_ip = task.result()
-                if ok and matched_ip:
-                    alive_ips.append(matched_ip)
-                    live_print(f"    🎯 命中: {matched_ip}")
-
-            # 补充新任务，维持并发数
-            while len(pending) < scan_workers:
+            # 初始化：启动 scan_workers 个任务
+            pending = set()
+            for _ in range(scan_ctl.limit):
                 try:
                     ip_port = next(task_gen)
                     pending.add(asyncio.create_task(check_one(ip_port, None, client)))
                 except StopIteration:
                     break
 
-            if completed % 5000 == 0:
-                elapsed = time.time() - start_time
-                rate = completed / elapsed if elapsed > 0 else 0
-                found = len(set(alive_ips))
-                msg = f" 📊 进度: {completed}/{total_tasks} | 发现: {found} | 命中IP: {len(found_set)}"
-                if rate > 0:
-                    remaining = (total_tasks - completed) / rate
-                    msg += f" | 速度: {rate:.0f}/s | 预估剩余: {remaining:.0f}s"
-                live_print(msg)
+            while pending:
+                done, pending = await monitor.wait(pending)
+                for task in done:
+                    completed += 1
+                    ok, matched_ip = task.result()
+                    if ok and matched_ip:
+                        _hit(matched_ip)
+                        live_print(f"    🎯 命中: {matched_ip}", LOG_DETAIL)
+
+                # 补充新任务，维持并发数（窗口随自适应控制器伸缩）
+                while len(pending) < scan_ctl.limit:
+                    try:
+                        ip_port = next(task_gen)
+                        pending.add(asyncio.create_task(check_one(ip_port, None, client)))
+                    except StopIteration:
+                        break
+
+                live_progress("scan", _progress_text)
 
         scan_elapsed = round(time.time() - start_time, 2)
         live_print(f"✅ 扫描结束 | 总发现 {len(set(alive_ips))} 个")
         live_print(f"   📊 统计: 命中IP={len(found_set)} | 存活IP={len(set(alive_ips))} | 扫描耗时 {scan_elapsed:.2f}s")
+        scan_ctl.close()
+        sweep_ctl.close()
+        monitor_lines = monitor.stop()
+        limiters = [scan_ctl, sweep_ctl] if SCAN_PREPASS else [scan_ctl]
+        for ctl in limiters:
+            for line in ctl.summary_lines():
+                live_print(f"   🎚️ {line}")
+        for line in monitor_lines:
+            live_print(f"   🩺 {line}")
+        if stats is not None:
+            stats["concurrency"] = [ctl.summary() for ctl in limiters]
+            stats["loop_monitor"] = monitor_lines
+            stats["scan_completed"] = completed
+        METRICS.incr("scan.tasks", completed)
+        METRICS.gauge("scan.rate_per_s", round(completed / scan_elapsed, 1) if scan_elapsed > 0 else 0)
 
     alive_ips = list(set(alive_ips))
     
     return alive_ips, scan_elapsed
 
+# ===============================
+# 2b. 多进程分片扫描（每个子进程独立事件循环 + 独立 client）
+# ===============================
+# 1 = 单进程（默认）；0 = 按 CPU 核数；也可用 main.py --shards N 覆盖
+SCAN_SHARDS = int(os.environ.get("SCAN_SHARDS", "1"))
+
+
+def _scan_shard(shard_id, segments, ports, found, history=None, sample=True):
+    """子进程入口：对分到的 C段 跑一遍全量扫描（不做增量验证），返回命中与吞吐统计"""
+    found_set = set(found)
+    shard_stats = {}
+    METRICS.reset()  # 进程池会复用子进程：只上报本分片的指标
+    alive, elapsed = asyncio.run(run_native_scan(segments, ports, found_set, shard_stats,
+                                                 verify_known=False, history=history, sample=sample))
+    result = {
+        "shard": shard_id,
+        "segments": len(segments),
+        "alive": alive,
+        "found": sorted(found_set.difference(found)),
+        "completed": shard_stats.get("scan_completed", 0),
+        "elapsed": elapsed,
+        "metrics": METRICS.snapshot(),
+        "loop_monitor": shard_stats.get("loop_monitor", []),
+    }
+    # 子进程经 os._exit 退出不走 atexit：返回结果前写完本进程的日志队列
+    flush_logs()
+    return result
+
+
+def _history_subset(history, segments):
+    """只把分片相关 C段 的历史传给子进程，减少跨进程序列化量"""
+    if history is None:
+        return None
+    seg_history = history.get("segments", {})
+    return {"run_counter": history.get("run_counter", 0),
+            "segments": {seg: seg_history[seg] for seg in segments if seg in seg_history}}
+
+
+@timed("phase.scan_sharded")
+async def run_sharded_scan(segments, ports, found_set, stats, shards, history=None, sample=True, client=None, on_hit=None):
+    """分片扫描：父进程先做增量验证，再把 C段 轮转切分给 shards 个子进程并行全量扫描，最后合并命中与 found_set。
+
+    client / on_hit 只作用于父进程的增量验证；子进程命中在该分片完成时逐个回调 on_hit。
+    """
+    alive_ips, _ = await run_native_scan(segments, ports, found_set, stats, verify_only=True,
+                                         client=client, on_hit=on_hit)
+    if not segments:
+        return alive_ips, 0
+
+    shards = max(1, min(shards, len(segments)))
+    parts = [segments[i::shards] for i in range(shards)]
+    frozen = sorted(found_set)
+    live_print(f"🧩 分片扫描: {len(segments)} 个 C段 → {shards} 个进程 (每进程并发: {os.environ.get('SCAN_WORKERS', '500')})")
+
+    start_time = time.time()
+    loop = asyncio.get_running_loop()
+    shard_lines, monitor_lines, total_completed = [], [], 0
+    # spawn：父进程已有事件循环与线程，fork 后状态不安全
+    with concurrent.futures.ProcessPoolExecutor(max_workers=shards, mp_context=multiprocessing.get_context("spawn")) as ex:
+        futures = [loop.run_in_executor(ex, _scan_shard, i + 1, part, ports, frozen, _history_subset(history, part), sample)
+                   for i, part in enumerate(parts)]
+        for fut in asyncio.as_completed(futures):
+            res = await fut
+            alive_ips.extend(res["alive"])
+            if on_hit is not None:
+                for ip_port in res["alive"]:
+                    on_hit(ip_port)
+            found_set.update(res["found"])
+            total_completed += res["completed"]
+            METRICS.merge(res["metrics"], timers=False)
+            monitor_lines.extend(f"#{res['shard']} {line}" for line in res["loop_monitor"])
+            rate = res["completed"] / res["elapsed"] if res["elapsed"] > 0 else 0
+            line = (f"#{res['shard']}: {res['segments']} 段 | {res['completed']} 任务 | "
+                    f"{res['elapsed']:.1f}s | {rate:.0f}/s | 命中 {len(res['alive'])}")
+            shard_lines.append(line)
+            live_print(f" 🧩 分片完成 {line}")
+
+    scan_elapsed = round(time.time() - start_time, 2)
+    alive_ips = list(set(alive_ips))
+    live_print(f"✅ 分片扫描结束 | 总发现 {len(alive_ips)} 个 | 耗时 {scan_elapsed:.2f}s | 合计 {total_completed / max(scan_elapsed, 1e-9):.0f}/s")
+    stats["shards"] = sorted(shard_lines)
+    if monitor_lines:
+        stats["loop_monitor"] = sorted(monitor_lines)
+    METRICS.gauge("scan.rate_per_s", round(total_completed / scan_elapsed, 1) if scan_elapsed > 0 else 0)
+    return alive_ips, scan_elapsed
+
+@timed("phase.fofa")
 def scrape_fofa():
     """FOFA 抓取（含 Cookie 失效检测与降级提示，使用 httpx 同步客户端）"""
     log_section("📡 抓取 FOFA 资源", "🔹")
@@ -495,11 +1108,11 @@ def scrape_fofa():
     try:
         r = httpx.get(FOFA_URL, headers=HEADERS, timeout=15)
         if "账号登录" in r.text or "login" in str(r.url).lower():
-            live_print("❌ 错误: FOFA Cookie 已失效！请更新 secrets.FOFA_COOKIE")
-            live_print("💡 提示: 在浏览器登录 fofa.info → F12 → Application → Cookies → 复制完整 Cookie 值")
+            live_print("❌ 错误: FOFA Cookie 已失效！请更新 secrets.FOFA_COOKIE", LOG_WARN)
+            live_print("💡 提示: 在浏览器登录 fofa.info → F12 → Application → Cookies → 复制完整 Cookie 值", LOG_WARN)
             return []
         if r.status_code == 403:
-            live_print("❌ 错误: FOFA 返回 403 禁止访问，可能被限流或封禁")
+            live_print("❌ 错误: FOFA 返回 403 禁止访问，可能被限流或封禁", LOG_WARN)
             return []
 
         raw_list = re.findall(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}:\d+)', r.text)
@@ -507,20 +1120,21 @@ def scrape_fofa():
             counts = Counter(raw_list)
             live_print(f"✅ 获取 {len(raw_list)} 条记录")
             for ip in sorted(counts.keys()):
-                live_print(f" - {ip:<21} ({counts[ip]}次)")
+                live_print(f" - {ip:<21} ({counts[ip]}次)", LOG_DETAIL)
             return list(counts.keys())
         else:
-            live_print(f"⚠️ FOFA 页面解析成功但未提取到 IP，可能页面结构变化")
+            live_print(f"⚠️ FOFA 页面解析成功但未提取到 IP，可能页面结构变化", LOG_WARN)
             return []
     except httpx.TimeoutException:
-        live_print("❌ FOFA 请求超时（15s），网络不稳定")
+        live_print("❌ FOFA 请求超时（15s），网络不稳定", LOG_WARN)
         return []
     except httpx.RequestError as e:
-        live_print(f"❌ FOFA 请求异常: {e}")
+        live_print(f"❌ FOFA 请求异常: {e}", LOG_WARN)
         return []
 
 _rtp_lock = threading.Lock()
 
+@timed("phase.rtp_template")
 def update_rtp_template():
     """RTP 模板下载（并发抓取两个源，线程安全）"""
     log_section("🔄 同步 RTP 模板", "🔹")
@@ -549,7 +1163,7 @@ def update_rtp_template():
                             continue
                 live_print(f"  📥 {url.split('/')[-1]} | 解析 {count} 条")
         except httpx.RequestError:
-            live_print(f"  ❌ 下载失败: {url}")
+            live_print(f"  ❌ 下载失败: {url}", LOG_WARN)
         return local_rtp
 
     # 并发下载两个 RTP 源，unique_rtp 写操作加锁保证线程安全
@@ -575,6 +1189,7 @@ def _channel_quality(name):
     if "高清" in name or "hd" in name_lower: return 2
     return 1
 
+@timed("phase.geo_review")
 def _review_geo(unique_all):
     """最终复核：逐 IP 归属地校验。
 
@@ -584,8 +1199,21 @@ def _review_geo(unique_all):
     geo_ips, lines = [], []
     geo_pass = geo_fail = 0
     total = len(unique_all)
-    for idx, ip in enumerate(unique_all, 1):
-        ok, desc = get_geo_info(ip.split(":")[0])
+    hosts = [ip.split(":")[0] for ip in unique_all]
+    # 预编译表：非混合 /24 的整段判定即单 IP 判定，通过的 IP O(1) 得出；
+    # 混合 /24 与被剔除的 IP（数量少）再逐 IP 查询，剔除日志保留省市 | ISP 作为原因
+    table = _get_geo_table()
+    verdicts, fallback = [None] * total, []
+    for i, host in enumerate(hosts):
+        if table is not None:
+            ok, is_mixed = _geo_table_bits(table, host)
+            if ok and not is_mixed:
+                verdicts[i] = (True, "预编译表: 广东电信 /24")
+                continue
+        fallback.append(i)
+    for i, verdict in zip(fallback, get_geo_info_many([hosts[i] for i in fallback])):
+        verdicts[i] = verdict
+    for idx, (ip, (ok, desc)) in enumerate(zip(unique_all, verdicts), 1):
         if ok:
             lines.append(f"  [{idx:02d}/{total:02d}] ✅ 有效 | {ip:<21} | {desc}")
             geo_ips.append(ip)
@@ -598,8 +1226,36 @@ def _review_geo(unique_all):
 # ===============================
 # 4. 主程序入口
 # ===============================
-async def main():
+def _build_handoff(geo_ips, rtp_entries, stats, fofa_ips):
+    """结构化交接清单：probe.py 直接读取 hostport / 频道 id，不再解析 servers × channels 的链接文件。
+
+    - hostports: 排序后的 'ip:port'
+    - segments: hostport 所在 C段（去重排序）
+    - origin: 来自 FOFA 的 hostport 下标（其余为扫描发现）
+    - rtp.ids: RTP 条目后缀（'239.x.x.x:port'），顺序与模板一致，拼接为 http://hp/rtp/<id>
+    """
+    fofa = set(fofa_ips)
+    return {
+        "version": 1,
+        "generated_at": int(time.time()),
+        "hostports": geo_ips,
+        "segments": sorted({hp.rsplit(".", 1)[0] for hp in geo_ips}),
+        "origin": {"fofa": [i for i, hp in enumerate(geo_ips) if hp in fofa]},
+        "discovery": {k: stats.get(k) for k in ("fofa", "segments_valid", "segments_scanned",
+                                                "scan_found", "geo_pass", "geo_fail")},
+        "scan_mode": SCAN_MODE,
+        "rtp": {"file": RTP_FILE, "ids": [suffix for _, suffix in rtp_entries]},
+    }
+
+
+async def main(shards=None, client=None, on_hit=None):
+    """源发现主流程。client / on_hit 透传给扫描（run.py 传入独立的扫描 client 并提前测速）；
+    返回交接清单 dict（同 HANDOFF_FILE 内容），无有效节点时返回 None"""
     start_time = time.time()
+    handoff = None
+    shards = SCAN_SHARDS if shards is None else shards
+    if shards <= 0:
+        shards = os.cpu_count() or 1
     stats = {"fofa": 0, "segments_total": 0, "segments_valid": 0,
              "scan_tasks": 0, "scan_found": 0, "geo_pass": 0, "geo_fail": 0,
              "blacklist_skip": 0}
@@ -633,12 +1289,31 @@ async def main():
 
     # 共享 found_set
     shared_found = set()
-    if sorted_ports:
-        sips, scan_seconds = await run_native_scan(valid_segs, sorted_ports, shared_found)
+    host_history = _load_host_history()
+    scan_segs, sample = valid_segs, True
+    if SCAN_MODE == "delta":
+        # 增量模式：选中的段全扫（不抽样），其余段依赖 source-ip.txt 增量验证覆盖已知主机
+        scan_segs, reasons = _select_delta_segments(valid_segs, host_history)
+        sample = False
+        stats["delta"] = reasons
+        live_print(f"🧮 增量扫描: {len(valid_segs)}→{len(scan_segs)} 个 C段 "
+                   f"(新 {reasons['new']} | 热 {reasons['hot']} | 到期 {reasons['due']} | 轮转 {reasons['rotate']}, 窗口 {DELTA_WINDOW_HOURS:g}h)")
+    stats["segments_scanned"] = len(scan_segs)
+    sampled = _sampled_segments(scan_segs, host_history) if sample else set()
+    if sorted_ports and shards > 1:
+        sips, scan_seconds = await run_sharded_scan(scan_segs, sorted_ports, shared_found, stats, shards, host_history, sample,
+                                                    client=client, on_hit=on_hit)
+        stats["scan_seconds"] = scan_seconds
+    elif sorted_ports:
+        sips, scan_seconds = await run_native_scan(scan_segs, sorted_ports, shared_found, stats,
+                                                   history=host_history, sample=sample, client=client, on_hit=on_hit)
         stats["scan_seconds"] = scan_seconds
     else:
         sips = []
     stats["scan_found"] = len(sips)
+    if sorted_ports:
+        _update_host_history(host_history, scan_segs, sips, sampled)
+        await asyncio.to_thread(_save_host_history, host_history)
     live_print(f"📊 扫描汇总: 发现 {len(sips)} 个存活 IP | 命中IP集: {len(shared_found)}")
 
     # ---- 扫描后更新端口统计（在 source-ip 写入前记录 scanned_ports） ----
@@ -651,12 +1326,13 @@ async def main():
     geo_ips, gp, gf, review_lines = await asyncio.to_thread(_review_geo, unique_all)
     stats["geo_pass"], stats["geo_fail"] = gp, gf
     for line in review_lines:
-        live_print(line)
+        live_print(line, LOG_DETAIL)
     
 
     # 4. 写入文件（标准 M3U 格式 + 原子化写入）
     if geo_ips:
         log_section("💾 数据归档 (output目录)", "🔹")
+        archive_started = time.monotonic()
         geo_ips.sort()
 
         # 写入 source-ip.txt（原子化，offload 到线程避免阻塞事件循环）
@@ -668,19 +1344,25 @@ async def main():
         if deactivated:
             stats["port_deactivated"] = deactivated
 
-        # 写入标准 M3U（RTP 解析与拼接改用 utils 公共函数）
+        # 写入未测速全量链接（RTP 解析与拼接改用 utils 公共函数）
         rtp_entries = parse_rtp_entries(RTP_FILE)
-        m3u_lines = build_m3u(rtp_entries, geo_ips)
-        compat_lines = build_compat(rtp_entries, geo_ips)
-
-        await asyncio.to_thread(atomic_write, SOURCE_M3U_FILE, "\n".join(m3u_lines))
-        live_print(f"  📝 {SOURCE_M3U_FILE} (标准M3U)")
-        await asyncio.to_thread(atomic_write, SOURCE_NONCHECK_FILE, "\n".join(compat_lines))
-        live_print(f"  📝 {SOURCE_NONCHECK_FILE} (兼容格式)")
+        # 单次遍历 servers × channels 流式写出兼容格式 + 压缩副本 + 紧凑表示（内容未变则不改写）；
+        # 纯净版 source-m3u.txt 只由 probe.py 写出，避免同一文件每次运行被两个阶段以不同内容改写
+        _, changed_files = await asyncio.to_thread(
+            write_outputs, [(SOURCE_NONCHECK_FILE, "compat")], rtp_entries, geo_ips,
+            compact=SOURCE_COMPACT_FILE, manifest=OUTPUT_MANIFEST)
+        for path in changed_files:
+            live_print(f"  📝 {path}")
+        if not changed_files:
+            live_print(f"  ℹ️ 链接内容未变，跳过改写 ({OUTPUT_MANIFEST})")
+        handoff = _build_handoff(geo_ips, rtp_entries, stats, fips)
+        await asyncio.to_thread(atomic_write, HANDOFF_FILE, json.dumps(handoff, ensure_ascii=False, separators=(",", ":")))
+        live_print(f"  📝 {HANDOFF_FILE} (测速交接清单)")
 
         stats["m3u_count"] = len(geo_ips) * len(rtp_entries)
         stats["rtp_count"] = len(rtp_entries)
         live_print(f"✨ 总结: {len(geo_ips)} 个服务器 | {len(rtp_entries)} 个频道 | {stats['m3u_count']} 条链接")
+        METRICS.add_time("phase.archive", time.monotonic() - archive_started)
         
     else:
         live_print("\n❌ 本次运行未找到有效节点")
@@ -705,20 +1387,29 @@ async def main():
     live_print(f"  │  └ (黑名单跳过) ........ {stats.get('blacklist_skip', 0):>4} 个")
     live_print(f"  │")
     live_print(f"  ├─ 阶段2: 端口扫描")
+    if "delta" in stats:
+        live_print(f"  │  ├ 增量扫描段 .......... {stats['segments_scanned']:>4} 个 (共 {stats['segments_valid']} 个有效)")
     live_print(f"  │  ├ 存活发现 ............ {scan_total:>4} 个新IP")
     live_print(f"  │  ├ FOFA 旧IP复用 ........ {fofa_only:>4} 个")
     live_print(f"  │  ├ 待复核总数 ........... {review_total:>4} 个IP")
     live_print(f"  │  ├ 扫描耗时 ............. {stats.get('scan_seconds', 0):>7.2f}s")
+    for line in stats.get("concurrency", []):
+        live_print(f"  │  ├ 并发窗口 ............. {line}")
+    for line in stats.get("shards", []):
+        live_print(f"  │  ├ 分片吞吐 ............. {line}")
+    for line in stats.get("loop_monitor", []):
+        live_print(f"  │  ├ 事件循环 ............. {line}")
     live_print(f"  │  └ 端口休眠 ............. {deactivated:>4} 个")
     live_print(f"  │")
     live_print(f"  ├─ 阶段3: 归属复核")
     live_print(f"  │  ├ 复核通过 ............ {stats['geo_pass']:>4} 个")
-    live_print(f"  │  └ 复核剔除 ............ {stats['geo_fail']:>4} 个")
+    live_print(f"  │  ├ 复核剔除 ............ {stats['geo_fail']:>4} 个")
+    live_print(f"  │  └ 区域串缓存 .......... {geo_cache_summary()}")
     live_print(f"  │")
     live_print(f"  ├─ 阶段4: 成品输出")
     live_print(f"  │  ├ 有效服务器 .......... {len(geo_ips):>4} 个 (→ output/source-ip.txt)")
     live_print(f"  │  ├ RTP 频道 ............ {rtp_count:>4} 个")
-    live_print(f"  │  ├ M3U 链接 ............ {m3u_count:>4} 条 (→ output/source-m3u.txt)")
+    live_print(f"  │  ├ M3U 链接 ............ {m3u_count:>4} 条 (→ output/source-m3u-noncheck.txt)")
     live_print(f"  │  └ 耗时 ............... {elapsed:>7.2f}s")
     live_print(f"  └──")
 
@@ -730,16 +1421,38 @@ async def main():
     write_summary(f"| ① 源获取 | FOFA 刮取 | {fofa_total} 个原始IP |")
     write_summary(f"| ① 源获取 | C段预过滤 | {stats['segments_valid']} 个有效 ({stats['segments_total']}→{stats['segments_valid']}) |")
     write_summary(f"| ① 源获取 | 黑名单跳过 | {stats.get('blacklist_skip', 0)} 个 |")
+    if "delta" in stats:
+        d = stats["delta"]
+        write_summary(f"| ② 端口扫描 | 增量扫描段 | {stats['segments_scanned']}/{stats['segments_valid']} "
+                      f"(新 {d['new']} / 热 {d['hot']} / 到期 {d['due']} / 轮转 {d['rotate']}) |")
     write_summary(f"| ② 端口扫描 | 新存活发现 | {scan_total} 个IP |")
     write_summary(f"| ② 端口扫描 | 扫描耗时 | {stats.get('scan_seconds', 0)}s |")
+    for line in stats.get("concurrency", []):
+        write_summary(f"| ② 端口扫描 | 并发窗口 | {line} |")
+    for line in stats.get("shards", []):
+        write_summary(f"| ② 端口扫描 | 分片吞吐 | {line} |")
+    for line in stats.get("loop_monitor", []):
+        write_summary(f"| ② 端口扫描 | 事件循环 | {line} |")
     write_summary(f"| ② 端口扫描 | 端口休眠 | {deactivated} 个 |")
     write_summary(f"| ③ 归属复核 | 复核通过 | {stats['geo_pass']} 个 |")
     write_summary(f"| ③ 归属复核 | 复核剔除 | {stats['geo_fail']} 个 |")
+    write_summary(f"| ③ 归属复核 | 区域串缓存 | {geo_cache_summary()} |")
     write_summary(f"| ④ 成品输出 | 有效服务器 | {len(geo_ips)} 个 |")
     write_summary(f"| ④ 成品输出 | RTP 频道 | {rtp_count} 个 |")
     write_summary(f"| ④ 成品输出 | M3U 总链接 | {m3u_count} 条 |")
 
-    write_summary(f"\n> 💾 输出文件: `output/source-ip.txt` `output/source-m3u.txt` `output/source-m3u-noncheck.txt`")
+    write_summary(f"\n> 💾 输出文件: `output/source-ip.txt` `output/source-m3u-noncheck.txt`")
+
+    # 运行指标（output/metrics.json 的 main 段）
+    for key in ("fofa", "segments_total", "segments_valid", "segments_scanned", "scan_found", "geo_pass", "geo_fail"):
+        METRICS.gauge(f"main.{key}", stats.get(key, 0))
+    METRICS.gauge("main.servers", len(geo_ips))
+    METRICS.gauge("main.elapsed_s", elapsed)
+    write_metrics("main")
+    return handoff
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="源发现：FOFA + C段扫描 + 归属复核 + 成品输出")
+    parser.add_argument("--shards", type=int, default=SCAN_SHARDS,
+                        help="全量扫描分片进程数（1=单进程，0=按 CPU 核数；默认读 SCAN_SHARDS）")
+    asyncio.run(main(shards=parser.parse_args().shards))
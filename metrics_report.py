@@ -0,0 +1,89 @@
+"""运行指标历史报告：列出最近 N 次运行的关键指标，并标记相对滚动基线的回归。
+
+数据来自 data/metrics-history.jsonl（每次运行由 main.py / probe.py / run.py 追加，按段保留最近
+METRICS_HISTORY_LIMIT 次）。每一行都与它之前同段最近 METRICS_BASELINE_RUNS 次的中位数比较，
+劣化超过 METRICS_REGRESSION_PCT% 的监测项（扫描 / 测速耗时、扫描 / 测速速率）标记为回归。
+
+用法（仓库根目录）：
+    python metrics_report.py [--section main|probe] [--last 20] [--markdown] [--fail-on-regression]
+"""
+import sys, time, argparse
+from utils import METRICS_HISTORY_FILE, load_metrics_history, find_regressions
+
+# 各段展示列：(表头, 取值函数)；分片扫描时 phase.scan 只含父进程增量验证，扫描耗时取 phase.scan_sharded
+COLUMNS = {
+    "main": (
+        ("扫描耗时s", lambda v: v.get("phase.scan_sharded", v.get("phase.scan"))),
+        ("扫描/s", lambda v: v.get("scan.rate_per_s")),
+        ("命中", lambda v: v.get("scan.hits")),
+        ("超时", lambda v: v.get("sweep.timeouts", 0) + v.get("scan.timeouts", 0)),
+        ("服务器", lambda v: v.get("main.servers")),
+        ("总耗时s", lambda v: v.get("main.elapsed_s")),
+    ),
+    "probe": (
+        ("测速耗时s", lambda v: v.get("probe.active_s", v.get("phase.probe"))),
+        ("测速/s", lambda v: v.get("probe.rate_per_s")),
+        ("有流", lambda v: v.get("probe.hosts_valid")),
+        ("带宽p50", lambda v: v.get("probe.bandwidth_p50_mbps")),
+        ("TTFB p50ms", lambda v: v.get("probe.ttfb_ms.p50")),
+        ("下载MB", lambda v: round(v["probe.bytes"] / 2**20, 1) if "probe.bytes" in v else None),
+        ("总耗时s", lambda v: v.get("probe.elapsed_s")),
+    ),
+}
+
+
+def _fmt(value):
+    if value is None:
+        return "-"
+    return f"{value:g}" if isinstance(value, (int, float)) else str(value)
+
+
+def section_report(rows, section, last):
+    """返回 (表头, 表格行, 最近一次的回归项)；每行回归只与它之前的同段历史比较"""
+    rows = [r for r in rows if r["section"] == section]
+    header = ["时间"] + [name for name, _ in COLUMNS[section]] + ["回归"]
+    table, latest = [], []
+    for i in range(max(0, len(rows) - last), len(rows)):
+        row = rows[i]
+        regressions = find_regressions(rows[:i], row)
+        flags = ", ".join(f"{key} +{pct:g}%" for key, _, _, pct in regressions)
+        table.append([time.strftime("%m-%d %H:%M", time.localtime(row["ts"]))]
+                     + [_fmt(get(row["values"])) for _, get in COLUMNS[section]] + [flags or "-"])
+        latest = regressions
+    return header, table, latest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--file", default=METRICS_HISTORY_FILE)
+    parser.add_argument("--section", choices=sorted(COLUMNS), help="只看某一段（默认全部）")
+    parser.add_argument("--last", type=int, default=20, help="显示最近 N 次运行")
+    parser.add_argument("--markdown", action="store_true", help="输出 Markdown 表格（可追加到 Job Summary）")
+    parser.add_argument("--fail-on-regression", action="store_true", help="最近一次运行有回归时以退出码 1 结束")
+    args = parser.parse_args()
+
+    rows = load_metrics_history(args.file)
+    if not rows:
+        print(f"⚠️ 无历史数据: {args.file}")
+        return
+    regressed = False
+    for section in ([args.section] if args.section else sorted(COLUMNS)):
+        header, table, latest = section_report(rows, section, args.last)
+        if not table:
+            continue
+        regressed |= bool(latest)
+        print(f"\n### {section}（最近 {len(table)} 次）\n" if args.markdown else f"\n📈 {section} — 最近 {len(table)} 次")
+        if args.markdown:
+            print("| " + " | ".join(header) + " |")
+            print("|" + "------|" * len(header))
+            for line in table:
+                print("| " + " | ".join(line) + " |")
+        else:
+            widths = [max(len(line[i]) for line in [header] + table) for i in range(len(header))]
+            for line in [header] + table:
+                print("  " + "  ".join(cell.rjust(w) for cell, w in zip(line, widths)))
+    sys.exit(1 if regressed and args.fail_on_regression else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
-import os, subprocess, time, json, asyncio
+import os, time, json, asyncio, hashlib, contextlib
 import httpx
 from datetime import datetime
-from utils import live_print, write_summary, atomic_write, log_section, parse_rtp_entries, build_m3u
+from utils import (live_print, LOG_DETAIL, LOG_WARN, write_summary, atomic_write, log_section, parse_rtp_entries, write_outputs,
+                   drop_output_variants, AdaptiveLimiter, TIMEOUT_SLACK, LoopMonitor, METRICS, write_metrics)
 
 # ===============================
 # 1. 配置区 (目录结构优化)
@@ -9,255 +10,825 @@ from utils import live_print, write_summary, atomic_write, log_section, parse_rt
 SOURCE_IP_FILE = "output/source-ip.txt"
 SOURCE_M3U_FILE = "output/source-m3u.txt"
 SOURCE_NONCHECK_FILE = "output/source-m3u-noncheck.txt"
+SOURCE_COMPACT_FILE = "output/source-m3u.compact.json"  # 频道模板 + 服务器列表 + 剔除组合
+OUTPUT_MANIFEST = "output/manifest.json"
+HANDOFF_FILE = "output/source-handoff.json"  # main.py 输出的结构化交接清单（优先读取）
 LOG_FILE = "output/log.txt"
 RTP_FILE = "data/rtp/ChinaTelecom-Guangdong.txt"
-SNAPSHOT_DIR = "data/.last_snapshot" # 变动比对快照目录
+CHANGE_STATE_FILE = "output/change-state.json"  # 变动检测基线：内容摘要 + 成员列表
+CHANGE_LIST_LIMIT = 20  # 日志 / 摘要中逐条列出的新增、消失服务器上限
 
 # 下游仓库联动触发已统一移至 .github/workflows/main.yml（通过 gh CLI 触发），
 # 避免与 Python 内触发重复，并集中错误处理与 Job Summary 汇报。
 # 下游仓库：JE668/m3u-checker-max (update.yml) / JE668/iptv-api (main.yml)
 
 # ===============================
-# 3. 比对与联动逻辑
+# 3. 比对与联动逻辑（内容摘要：与顺序无关，无 git 子进程、无排序）
 # ===============================
+def _set_digest(items):
+    """与顺序无关的集合摘要：各元素 blake2b 取 128 位后求和取模，O(n) 且无需排序"""
+    total = 0
+    for item in items:
+        total += int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest(), "big")
+    return f"{total % (1 << 128):032x}"
+
+
 def has_data_changed(filename):
+    """与上次记录的摘要比对 filename（每行一个 hostport）的内容变动。
+
+    返回 (changed, added, removed)：added / removed 为新出现 / 消失的 hostport（排序后的列表）。
+    摘要与成员列表保存在 CHANGE_STATE_FILE，仅在有变动时改写；无基线时视为有变动且全部计为新增。
+    """
     live_print(f"━━━ 🕵️ 变动检测 ━━━━━━━━━━━━━━━━━━━━━━━━━━  📂 {filename}")
-    if not os.path.exists(filename): return False
+    if not os.path.exists(filename):
+        return False, [], []
     with open(filename, 'r', encoding='utf-8') as f:
-        current = sorted([l.strip() for l in f if l.strip()])
+        current = {l.strip() for l in f if l.strip()}
+    digest = _set_digest(current)
 
-    # 策略1: 与本地 Git HEAD 对比
+    state = {}
     try:
-        cmd = ['git', 'show', f'HEAD:{filename}']
-        res = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-        if res.returncode == 0:
-            old = sorted([l.strip() for l in res.stdout.splitlines() if l.strip()])
-            live_print(f" 📊 历史: {len(old)}行 | 当前: {len(current)}行")
-            if current == old:
-                live_print(" ℹ️ 结论: 无变动"); return False
-            live_print(" 🆕 结论: 有变动")
-        else:
-            live_print(" 🆕 结论: 无 Git 历史（首次或 shallow clone）")
-    except (OSError, subprocess.SubprocessError) as e:
-        live_print(f" ⚠️ Git 比对异常: {e}，回退到快照比对")
-
-    # 策略2: 快照比对（shallow clone 容错）
-    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
-    snapshot_path = os.path.join(SNAPSHOT_DIR, os.path.basename(filename))
-    if os.path.exists(snapshot_path):
-        with open(snapshot_path, 'r', encoding='utf-8') as f:
-            snap = sorted([l.strip() for l in f if l.strip()])
-        if current == snap:
-            live_print(" ℹ️ 快照比对: 无变动"); return False
-        live_print(" 🆕 快照比对: 有变动")
-
-    # 更新快照
-    with open(snapshot_path, 'w', encoding='utf-8') as f:
-        f.write("\n".join(current))
-    return True
+        with open(CHANGE_STATE_FILE, encoding="utf-8") as f:
+            state = json.load(f).get(os.path.basename(filename), {})
+    except (OSError, ValueError):
+        pass
+    if state.get("digest") == digest:
+        live_print(f" ℹ️ 结论: 无变动 ({len(current)} 台, 摘要 {digest[:12]})")
+        return False, [], []
+
+    previous = set(state.get("members", []))
+    added, removed = sorted(current - previous), sorted(previous - current)
+    if state:
+        live_print(f" 🆕 结论: 有变动 | 历史 {len(previous)} 台 → 当前 {len(current)} 台 | +{len(added)} -{len(removed)}")
+    else:
+        live_print(f" 🆕 结论: 无基线（首次运行），当前 {len(current)} 台")
+    _save_change_state(filename, digest, current)
+    return True, added, removed
+
+
+def _save_change_state(filename, digest, members):
+    try:
+        with open(CHANGE_STATE_FILE, encoding="utf-8") as f:
+            states = json.load(f)
+    except (OSError, ValueError):
+        states = {}
+    states[os.path.basename(filename)] = {"digest": digest, "count": len(members),
+                                          "updated_at": int(time.time()), "members": sorted(members)}
+    atomic_write(CHANGE_STATE_FILE, json.dumps(states, ensure_ascii=False, indent=1) + "\n")
+
 
 # ===============================
-# 4. 抽样测速逻辑（量化版：512KB + 带宽计算）
+# 4. 抽样测速逻辑（量化版：connect / TTFB / 稳态吞吐分离 + 稳定即停）
 # ===============================
-PROBE_DOWNLOAD_TARGET = 512 * 1024  # 512KB，比原128KB多4倍数据量，支持带宽计算
+PROBE_DOWNLOAD_TARGET = 512 * 1024  # 下载上限 512KB（稳态速率已确定时会提前结束）
 PROBE_TIMEOUT_PER_URL = 6           # 单URL最多6秒（原5秒）
+PROBE_CONNECT_TIMEOUT = 4           # 测速 connect 超时（秒）
+PROBE_READ_TIMEOUT = 6              # 测速单次 read 超时（秒）
+PROBE_TIMEOUT_AT = PROBE_CONNECT_TIMEOUT * TIMEOUT_SLACK  # 失败且耗时达到此值 → 自适应窗口计为超时
+PROBE_CHUNK_SIZE = 16 * 1024        # 预热字节：首个 16KB（udpxy 加入组播后的突发）不计入稳态吞吐
+PROBE_SAMPLE_INTERVAL = 0.25        # 稳态速率采样窗口（秒）
+PROBE_STABLE_WINDOWS = 3            # 连续 N 个采样窗口速率波动在容差内 → 判定稳定
+PROBE_STABLE_TOLERANCE = 0.1        # 相对波动容差（(max-min)/mean）
+PROBE_MIN_STEADY_BYTES = 128 * 1024 # 稳态阶段至少积累这么多字节才允许提前结束
+PROBE_URLS_PER_HOST = 3             # 每个 hostport 抽测的频道数（取模板前 N 个，同 IP 并发）
 SOURCE_META_FILE = "output/source-meta.json"
+META_FIELDS = ("bandwidth_mbps", "connect_ms", "ttfb_ms", "ts_mbps", "cc_error_rate")
+
+# --- MPEG-TS 增量校验（memoryview 跨步切片，整块只拷贝包头字节） ---
+PROBE_TS_CHECK = os.environ.get("PROBE_TS_CHECK", "1") != "0"
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+TS_NULL_PID = 0x1FFF
+TS_MIN_PACKETS = 50        # 至少这么多有效包（不含空包）才算“有流”（约 9KB）
+TS_MIN_VALID_RATIO = 0.9   # 同步包（含空包）字节占比低于此视为非 TS（HTML 错误页 / 垃圾数据）
+
+
+class TSValidator:
+    """增量 MPEG-TS 校验器：逐块 feed(chunk)，统计 188 字节同步、PID 与连续计数器（CC）错误。
+
+    - 同步状态下整块按 188 跨步切出同步字节与包头三字节，不拷贝负载
+    - 块边界的残包只保留不足一包的尾部，与下一块开头拼成一个包
+    - 失步后按“连续 3 个同步字节”重新捕获，跳过的字节计为无效
+    - 空包（PID 0x1FFF）计入 null_packets 而非 packets：纯填充流不算有流
+    """
+
+    def __init__(self):
+        self.bytes_seen = 0
+        self.packets = 0
+        self.null_packets = 0
+        self.cc_checked = 0
+        self.cc_errors = 0
+        self.sync_losses = 0
+        self.pids = set()
+        self._last_cc = {}
+        self._synced = False
+        self._tail = b""
+
+    @property
+    def valid_ratio(self):
+        """同步包（含空包）字节占比：判断内容是否为 TS"""
+        return (self.packets + self.null_packets) * TS_PACKET_SIZE / self.bytes_seen if self.bytes_seen else 0.0
+
+    @property
+    def payload_ratio(self):
+        """非空包字节占比：折算有效 TS 码率"""
+        return self.packets * TS_PACKET_SIZE / self.bytes_seen if self.bytes_seen else 0.0
+
+    @property
+    def cc_error_rate(self):
+        return self.cc_errors / self.cc_checked if self.cc_checked else 0.0
+
+    def is_valid(self):
+        return self.packets >= TS_MIN_PACKETS and self.valid_ratio >= TS_MIN_VALID_RATIO
+
+    def feed(self, chunk):
+        self.bytes_seen += len(chunk)
+        mv = memoryview(chunk)
+        if self._tail:
+            if self._synced:
+                need = TS_PACKET_SIZE - len(self._tail)
+                if len(mv) < need:
+                    self._tail += bytes(mv)
+                    return
+                head = memoryview(self._tail + bytes(mv[:need]))
+                self._tail = b""
+                self._consume(head, 0)
+                mv = mv[need:]
+            else:
+                # 失步等待确认的残片（最多两包多），拼接代价可忽略
+                mv = memoryview(self._tail + bytes(mv))
+                self._tail = b""
+
+        pos = 0
+        while pos < len(mv):
+            if not self._synced:
+                pos = self._resync(mv, pos)
+                if pos is None:
+                    return
+            pos = self._consume(mv, pos)
+            if self._synced:
+                self._tail = bytes(mv[pos:])
+                return
+
+    def _resync(self, mv, pos):
+        """从 pos 起寻找连续 3 个间隔 188 的同步字节；数据不足以确认时存为残片返回 None"""
+        span = 2 * TS_PACKET_SIZE
+        end = len(mv)
+        for i in range(pos, end):
+            if mv[i] != TS_SYNC_BYTE:
+                continue
+            if i + span >= end:
+                self._tail = bytes(mv[i:])
+                return None
+            if mv[i + TS_PACKET_SIZE] == TS_SYNC_BYTE and mv[i + span] == TS_SYNC_BYTE:
+                self._synced = True
+                return i
+        return None
+
+    def _consume(self, mv, pos):
+        """处理 pos 起所有完整包，返回第一个未处理字节位置；遇到同步字节错误则标记失步并停在该包"""
+        n = (len(mv) - pos) // TS_PACKET_SIZE
+        if n == 0:
+            return pos
+        end = pos + n * TS_PACKET_SIZE
+        syncs = mv[pos:end:TS_PACKET_SIZE].tobytes()
+        if syncs.count(TS_SYNC_BYTE) != n:
+            n = next(k for k, b in enumerate(syncs) if b != TS_SYNC_BYTE)
+            end = pos + n * TS_PACKET_SIZE
+            self._synced = False
+            self.sync_losses += 1
+
+        last_cc, cc_errors, cc_checked, nulls = self._last_cc, 0, 0, 0
+        for b1, b2, b3 in zip(mv[pos + 1:end:TS_PACKET_SIZE], mv[pos + 2:end:TS_PACKET_SIZE],
+                              mv[pos + 3:end:TS_PACKET_SIZE]):
+            pid = ((b1 & 0x1F) << 8) | b2
+            if pid == TS_NULL_PID:
+                nulls += 1
+                continue  # 空包不递增 CC，也不算有效包
+            if not b3 & 0x10:
+                continue  # 无负载包不递增 CC
+            cc = b3 & 0x0F
+            prev = last_cc.get(pid)
+            if prev is not None:
+                cc_checked += 1
+                if cc != prev and cc != (prev + 1) & 0x0F:  # 允许一次重复包
+                    cc_errors += 1
+            last_cc[pid] = cc
+        self.packets += n - nulls
+        self.null_packets += nulls
+        self.cc_errors += cc_errors
+        self.cc_checked += cc_checked
+        self.pids.update(last_cc)
+        return end
 
-async def async_fast_ip_probe(client, host_port, url_list):
+
+async def async_fast_ip_probe(client, host_port, url_list, metrics=METRICS):
     """
     异步测试IP:port的流质量（同IP的多个URL并发测试）
-    返回: (is_alive, host_port, bandwidth_mbps, log_message)
+    返回: (is_alive, host_port, bandwidth_mbps, log_message, detail)
+    - bandwidth_mbps 为稳态吞吐（首字节之后的下载速率，不含 connect 与 udpxy 组播加入延迟）
+    - detail: {"connect_ms", "ttfb_ms", "throughput_mbps", "bytes", "ts_mbps", "cc_error_rate"}（取最佳 URL 的结果）
+    - metrics: 记录字节数 / 时延直方图的 Metrics（run.py 提前测速传入独立实例，测速阶段再并入 probe 段）
     """
     # 同IP的多个URL并发测试（最多3个）
     async def _probe_single_url(test_url):
-        start = time.time()
+        start = time.monotonic()
+        marks = {}
+
+        async def _trace(event, info):
+            # httpcore 事件：复用 keep-alive 连接时不会触发 connect，connect_ms 记为 None
+            if event == "connection.connect_tcp.complete":
+                marks["connect"] = time.monotonic()
+
+        detail = {"connect_ms": None, "ttfb_ms": None, "throughput_mbps": 0.0, "bytes": 0,
+                  "ts_mbps": None, "cc_error_rate": None}
+        ts = TSValidator() if PROBE_TS_CHECK else None
         try:
-            async with client.stream("GET", test_url, timeout=httpx.Timeout(10, connect=4, read=6)) as r:
+            async with client.stream("GET", test_url, timeout=httpx.Timeout(10, connect=PROBE_CONNECT_TIMEOUT, read=PROBE_READ_TIMEOUT),
+                                     extensions={"trace": _trace}) as r:
                 if r.status_code == 200:
-                    down = 0
-                    async for chunk in r.aiter_bytes(chunk_size=64*1024):
+                    down = steady_bytes = 0
+                    first_at = steady_at = sample_at = last_at = None
+                    samples = []
+                    # 不指定 chunk_size：数据一到即返回，first_at 才是真正的首字节时间（不等凑满一个块）
+                    async for chunk in r.aiter_bytes():
+                        if not chunk:
+                            continue
+                        now = last_at = time.monotonic()
                         down += len(chunk)
-                        if down >= PROBE_DOWNLOAD_TARGET:
-                            elapsed = time.time() - start
-                            bw = round(down * 8 / elapsed / 1_000_000, 1)
-                            return True, bw
-                        if time.time() - start > PROBE_TIMEOUT_PER_URL:
+                        if ts is not None:
+                            ts.feed(chunk)
+                        if first_at is None:
+                            first_at = now
+                        if steady_at is None:
+                            # 预热字节（PROBE_CHUNK_SIZE）只用于 TTFB，不计入稳态吞吐
+                            if down >= PROBE_CHUNK_SIZE:
+                                steady_at = sample_at = now
+                        else:
+                            steady_bytes += len(chunk)
+                        if steady_at is not None and now - sample_at >= PROBE_SAMPLE_INTERVAL:
+                            # 滚动估计：预热结束以来的累计速率，随采样收敛，不受单个突发块影响
+                            samples.append(steady_bytes / (now - steady_at))
+                            sample_at = now
+                            recent = samples[-PROBE_STABLE_WINDOWS:]
+                            if (len(recent) == PROBE_STABLE_WINDOWS and steady_bytes >= PROBE_MIN_STEADY_BYTES
+                                    and (max(recent) - min(recent)) <= PROBE_STABLE_TOLERANCE * (sum(recent) / len(recent))):
+                                break
+                        if down >= PROBE_DOWNLOAD_TARGET or now - start > PROBE_TIMEOUT_PER_URL:
                             break
-                    # 下载不足但拿到了一些数据
-                    elapsed = time.time() - start
-                    bw = round(down * 8 / elapsed / 1_000_000, 1) if down > 4096 else 0
+
+                    if "connect" in marks:
+                        detail["connect_ms"] = round((marks["connect"] - start) * 1000)
+                        metrics.observe("probe.connect_ms", (marks["connect"] - start) * 1000)
+                    if first_at is not None:
+                        detail["ttfb_ms"] = round((first_at - start) * 1000)
+                        metrics.observe("probe.ttfb_ms", (first_at - start) * 1000)
+                    detail["bytes"] = down
+                    metrics.incr("probe.bytes", down)
+                    if steady_bytes and last_at > steady_at:
+                        bw = steady_bytes * 8 / (last_at - steady_at) / 1_000_000
+                    else:
+                        # 没有稳态数据（只收到预热字节）：退化为总字节/总耗时
+                        bw = down * 8 / max(time.monotonic() - start, 1e-6) / 1_000_000
+                    bw = round(bw, 1) if down > 4096 else 0
+                    detail["throughput_mbps"] = bw
+                    if ts is not None:
+                        # 有效 TS 码率 = 稳态吞吐 × 非空包字节占比；非 TS 内容（错误页 / 垃圾数据 / 纯空包）不算有流
+                        detail["ts_mbps"] = round(bw * ts.payload_ratio, 1)
+                        detail["cc_error_rate"] = round(ts.cc_error_rate, 4)
+                        # 空响应体（只回状态码的服务器）按“无流”处理，不标记为非 TS
+                        if ts.bytes_seen and not ts.is_valid():
+                            detail["invalid_ts"] = True
+                            return False, 0.0, detail
                     if bw > 0:
-                        return True, bw
-        except (httpx.RequestError, httpx.TimeoutException):
-            pass
-        return False, 0.0
+                        return True, bw, detail
+        except httpx.TimeoutException:
+            metrics.incr("probe.timeouts")
+            detail["error"] = "timeout"
+        except httpx.ConnectError:
+            metrics.incr("probe.errors")
+            detail["error"] = "connect"
+        except httpx.RequestError:
+            metrics.incr("probe.errors")
+        return False, 0.0, detail
     
     # 并发测试最多3个URL
-    tasks = [_probe_single_url(url) for url in url_list[:3]]
+    tasks = [_probe_single_url(url) for url in url_list[:PROBE_URLS_PER_HOST]]
+    metrics.incr("probe.urls", len(tasks))
     results = await asyncio.gather(*tasks)
     
     # 取最佳结果
-    best_bw = 0
-    for is_alive, bw in results:
+    best_bw, best_detail = 0, results[0][2] if results else {}
+    for is_alive, bw, detail in results:
         if is_alive and bw > best_bw:
-            best_bw = bw
-    
+            best_bw, best_detail = bw, detail
+
+    timing = f" | TTFB {best_detail['ttfb_ms']}ms" if best_detail.get("ttfb_ms") is not None else ""
     if best_bw > 0:
-        return True, host_port, best_bw, f" 🟢 [存活] {host_port:<21} | {best_bw:.1f}Mbps"
+        return True, host_port, best_bw, f" 🟢 [存活] {host_port:<21} | {best_bw:.1f}Mbps{timing}", best_detail
     elif any(r[0] for r in results):
-        return True, host_port, best_bw, f" 🟡 [弱流] {host_port:<21} | {best_bw:.1f}Mbps"
+        return True, host_port, best_bw, f" 🟡 [弱流] {host_port:<21} | {best_bw:.1f}Mbps{timing}", best_detail
+    elif any(d.get("invalid_ts") for _, _, d in results):
+        return False, host_port, 0.0, f" 🔴 [非TS] {host_port:<21}", best_detail
+    else:
+        # 所有 URL 都是超时 / 连接失败：可能只是网络拥塞，调用方可据此决定是否重测
+        best_detail["transient"] = bool(results) and all(d.get("error") for _, _, d in results)
+        return False, host_port, 0.0, f" 🔴 [无流] {host_port:<21}", best_detail
+
+
+# ===============================
+# 4b. 频道覆盖抽测（按预算轮转抽样 server × 频道，记住结果）
+# ===============================
+COVERAGE_FILE = "data/channel-coverage.json"
+COVERAGE_BUDGET = int(os.environ.get("COVERAGE_BUDGET", "0"))   # 每次运行的频道探测总数，0 = 关闭
+COVERAGE_STRICT = os.environ.get("COVERAGE_STRICT", "0") == "1"  # 1 = 只输出已知可用的频道/服务器组合
+COVERAGE_BAD_STREAK = 2            # 连续失败 N 次的组合视为已知不可用，从 M3U 剔除
+COVERAGE_TIMEOUT = 4               # 单个频道探测上限（秒），拿到足够有效 TS 包即结束
+COVERAGE_FORGET_DAYS = 30          # 服务器超过 N 天未被测到则清理其记录
+
+
+def _load_coverage():
+    """读取覆盖记录：{"version", "cursor", "servers": {hp: {suffix: [ok, streak, ts]}}}"""
+    try:
+        with open(COVERAGE_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") == 1:
+            return data
+    except (OSError, ValueError):
+        pass
+    return {"version": 1, "cursor": 0, "servers": {}}
+
+
+def _save_coverage(coverage, now):
+    cutoff = now - COVERAGE_FORGET_DAYS * 86400
+    servers = {hp: pairs for hp, pairs in coverage["servers"].items()
+               if any(rec[2] >= cutoff for rec in pairs.values())}
+    coverage["servers"] = servers
+    # 每台服务器一行，diff 友好
+    body = ",\n".join(f"    {json.dumps(hp)}: {json.dumps(pairs, sort_keys=True, separators=(',', ':'))}"
+                      for hp, pairs in sorted(servers.items()))
+    content = (f'{{\n  "version": 1,\n  "cursor": {coverage["cursor"]},\n'
+               f'  "servers": {{\n{body}\n  }}\n}}\n') if servers else json.dumps(coverage) + "\n"
+    atomic_write(COVERAGE_FILE, content)
+
+
+def _coverage_plan(hostports, rtp_entries, cursor, budget):
+    """按预算从 服务器 × 频道 网格中取一段连续组合，cursor 在网格上逐次前移。
+
+    网格第 p 个组合 = (第 p % H 台服务器, 第 (p // H + p % H) % n 个频道)：同一轮内服务器间频道错开，
+    预算小于服务器数时下次从上次停下的服务器继续；服务器列表不变时 ceil(H × n / budget) 次运行
+    恰好覆盖全部组合各一次。返回 ([(hp, suffix), ...], 新 cursor)"""
+    n = len(rtp_entries)
+    if not hostports or not n or budget <= 0:
+        return [], cursor
+    hps = sorted(hostports)
+    h = len(hps)
+    total = h * n
+    start = cursor % total
+    plan = []
+    for p in range(start, start + min(budget, total)):
+        p %= total
+        j = p % h
+        plan.append((hps[j], rtp_entries[(p // h + j) % n][1]))
+    return plan, (start + len(plan)) % total
+
+
+async def async_channel_probe(client, hp, suffix):
+    """单个频道探测：拿到 TS_MIN_PACKETS 个有效 TS 包即判定可用，否则不可用"""
+    ts = TSValidator()
+    start = time.monotonic()
+    try:
+        async with client.stream("GET", f"http://{hp}/rtp/{suffix}",
+                                 timeout=httpx.Timeout(COVERAGE_TIMEOUT, connect=2)) as r:
+            if r.status_code != 200:
+                return False
+            async for chunk in r.aiter_bytes(chunk_size=PROBE_CHUNK_SIZE):
+                ts.feed(chunk)
+                METRICS.incr("coverage.bytes", len(chunk))
+                if ts.packets >= TS_MIN_PACKETS or time.monotonic() - start > COVERAGE_TIMEOUT:
+                    break
+    except httpx.TimeoutException:
+        METRICS.incr("coverage.timeouts")
+        return False
+    except httpx.RequestError:
+        return False
+    return ts.is_valid()
+
+
+async def run_coverage(client, hostports, rtp_entries, coverage, limiter):
+    """执行一轮覆盖抽测并更新 coverage，返回 (探测数, 可用数)"""
+    plan, coverage["cursor"] = _coverage_plan(hostports, rtp_entries, coverage.get("cursor", 0), COVERAGE_BUDGET)
+    if not plan:
+        return 0, 0
+    live_print(f"━━━ 🧭 频道覆盖抽测 ━━━━━━━━━━━━━━━━━━━━━━  📺 {len(plan)} 组合 / {len(hostports)} 服务器")
+
+    async def _one(hp, suffix):
+        async with limiter:
+            t0 = time.monotonic()
+            ok = await async_channel_probe(client, hp, suffix)
+            limiter.record(time.monotonic() - t0)
+            METRICS.observe("coverage.probe_ms", (time.monotonic() - t0) * 1000)
+            return hp, suffix, ok
+
+    now = int(time.time())
+    ok_count = 0
+    servers = coverage["servers"]
+    for hp, suffix, ok in await asyncio.gather(*(_one(hp, suffix) for hp, suffix in plan)):
+        prev = servers.setdefault(hp, {}).get(suffix)
+        streak = prev[1] + 1 if prev and bool(prev[0]) == ok else 1
+        servers[hp][suffix] = [int(ok), streak, now]
+        ok_count += ok
+    return len(plan), ok_count
+
+
+def coverage_filter(coverage, strict=COVERAGE_STRICT):
+    """返回 write_outputs 用的 (hp, suffix) -> bool 过滤器：
+    默认剔除连续失败 ≥ COVERAGE_BAD_STREAK 的组合；strict 模式下有覆盖记录的服务器只保留最近一次可用的组合，
+    从未被抽测的服务器按默认规则处理（不因缺少记录被整台剔除）"""
+    servers = coverage.get("servers", {})
+
+    def _keep(hp, suffix):
+        pairs = servers.get(hp)
+        rec = pairs.get(suffix) if pairs else None
+        if strict and pairs:
+            return bool(rec and rec[0])
+        return not (rec and not rec[0] and rec[1] >= COVERAGE_BAD_STREAK)
+    return _keep
+
+
+# ===============================
+# 4c. 测速结果缓存（按 hostport 记录，稳定服务器延长复测间隔）
+# ===============================
+PROBE_CACHE_FILE = "data/probe-cache.json"
+PROBE_CACHE = os.environ.get("PROBE_CACHE", "1") != "0"
+PROBE_CACHE_TTL_HOURS = float(os.environ.get("PROBE_CACHE_TTL_HOURS", "3"))  # 首次成功后的基础 TTL（与调度间隔一致）
+PROBE_CACHE_MAX_HOURS = float(os.environ.get("PROBE_CACHE_MAX_HOURS", "24"))  # 连续成功后 TTL 上限
+PROBE_CACHE_MAX_FLIPS = 3          # 抖动计数上限：每次“失败→成功”翻转 TTL 减半
+PROBE_CACHE_DECAY_STREAK = 8       # 连续成功每满 N 次抖动计数减一
+
+
+def _load_probe_cache():
+    """读取测速缓存：{hp: {"ok", "streak", "flips", "ts", "bandwidth_mbps", ...}}"""
+    try:
+        with open(PROBE_CACHE_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") == 1:
+            return data.get("servers", {})
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
+def _save_probe_cache(cache):
+    body = ",\n".join(f"    {json.dumps(hp)}: {json.dumps(rec, sort_keys=True, separators=(',', ':'))}"
+                      for hp, rec in sorted(cache.items()))
+    atomic_write(PROBE_CACHE_FILE, f'{{\n  "version": 1,\n  "servers": {{\n{body}\n  }}\n}}\n')
+
+
+def _cache_ttl(rec):
+    """TTL（秒）：连续成功每次翻倍（上限 PROBE_CACHE_MAX_HOURS），近期有过失败→成功翻转的按次数减半"""
+    if not rec.get("ok"):
+        return 0
+    ttl = PROBE_CACHE_TTL_HOURS * 2 ** min(rec.get("streak", 1) - 1, 8)
+    ttl = min(ttl, PROBE_CACHE_MAX_HOURS) / 2 ** rec.get("flips", 0)
+    return ttl * 3600
+
+
+def _cache_fresh(cache, hp, now):
+    rec = cache.get(hp)
+    return rec is not None and now - rec.get("ts", 0) < _cache_ttl(rec)
+
+
+def _update_probe_cache(cache, hp, ok, meta, now):
+    """记录一次实测结果：成功延长 streak，失败清零；失败后重新成功计一次抖动"""
+    rec = cache.get(hp, {})
+    was_ok, flips = rec.get("ok"), rec.get("flips", 0)
+    if ok:
+        streak = rec.get("streak", 0) + 1 if was_ok else 1
+        if was_ok is False:
+            flips = min(flips + 1, PROBE_CACHE_MAX_FLIPS)
+        elif streak % PROBE_CACHE_DECAY_STREAK == 0:
+            flips = max(0, flips - 1)
+        cache[hp] = dict(meta, ok=True, streak=streak, flips=flips, ts=int(now))
     else:
-        return False, host_port, 0.0, f" 🔴 [无流] {host_port:<21}"
+        cache[hp] = {"ok": False, "streak": 0, "flips": flips, "ts": int(now)}
+
+
+def _load_handoff():
+    """读取 main.py 的交接清单 → {ip: [(hp, urls), ...]}；缺失、损坏或比链接文件旧时返回 None"""
+    try:
+        if (os.path.exists(SOURCE_NONCHECK_FILE)
+                and os.path.getmtime(HANDOFF_FILE) < os.path.getmtime(SOURCE_NONCHECK_FILE)):
+            return None  # 链接文件在交接清单之后被改写，以链接文件为准
+        with open(HANDOFF_FILE, encoding="utf-8") as f:
+            return _handoff_targets(json.load(f))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _handoff_targets(data):
+    """交接清单 dict → {ip: [(hp, urls), ...]}；版本不符时返回 None"""
+    if data.get("version") != 1:
+        return None
+    ids = data["rtp"]["ids"][:PROBE_URLS_PER_HOST]
+    ip_to_hostports = {}
+    for hp in data["hostports"]:
+        ip_to_hostports.setdefault(hp.rsplit(":", 1)[0], []).append((hp, probe_urls(hp, ids)))
+    return ip_to_hostports
+
+
+def probe_urls(hp, rtp_ids):
+    """hostport 的抽测 URL（取前 PROBE_URLS_PER_HOST 个频道）"""
+    return [f"http://{hp}/rtp/{sid}" for sid in rtp_ids[:PROBE_URLS_PER_HOST]]
+
+
+def _parse_noncheck():
+    """回退路径：逐行解析 source-m3u-noncheck.txt → {ip: [(hp, urls), ...]}（hostport 去重，按出现顺序）"""
+    if not os.path.exists(SOURCE_NONCHECK_FILE):
+        return {}
+    ip_to_hostports, url_map = {}, {}
+    with open(SOURCE_NONCHECK_FILE, encoding="utf-8") as f:
+        for line in f:
+            if "," not in line:
+                continue
+            try:
+                url = line.strip().split(",", 1)[1]
+                host_port = url.split("/")[2]
+                ip_key = host_port.split(":")[0]
+            except (ValueError, IndexError): continue
+            urls = url_map.get(host_port)
+            if urls is None:
+                urls = url_map[host_port] = []
+                ip_to_hostports.setdefault(ip_key, []).append((host_port, urls))
+            if len(urls) < PROBE_URLS_PER_HOST:
+                urls.append(url)
+    return ip_to_hostports
 
 
 # ===============================
 # 5. 运行主逻辑 (async)
 # ===============================
-async def main():
+def new_probe_client():
+    """测速用 httpx 客户端（run.py 单进程模式下由提前测速与测速阶段共用）"""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=300, max_connections=1000),
+        timeout=httpx.Timeout(connect=PROBE_CONNECT_TIMEOUT, read=PROBE_READ_TIMEOUT, write=5, pool=2)
+    )
+
+
+async def main(client=None, handoff=None, prefetched=None, prefetched_metrics=None):
+    """测速主流程。
+
+    - client: 外部共享的 httpx.AsyncClient（复用提前测速的连接池，不关闭）；None 时自建
+    - handoff: 内存中的交接清单（main.main 的返回值）；None 时读 HANDOFF_FILE / 回退解析链接文件
+    - prefetched: {hp: asyncio.Task}，扫描期间已提前启动的 async_fast_ip_probe 任务，直接取结果，超时 / 连接失败的重测
+    - prefetched_metrics: 提前测速记录的 Metrics（字节数、时延直方图、phase.probe_early 忙碌时间），
+      写出前并入 probe 段，使 run.py 与单独运行的 probe 段口径一致
+
+    返回直接复用的提前测速结果数。
+    """
     start_time = time.time()
-    changed = has_data_changed(SOURCE_IP_FILE)
+    changed, added, removed = has_data_changed(SOURCE_IP_FILE)
 
     # 预初始化，确保即使数据为空也有定义，防止 summary 阶段 NameError
-    ip_map, url_map = {}, {}
     valid_hostports = set()
+    concurrency_lines = []
+    monitor_lines = []
+    coverage_tested = coverage_ok = 0
+    cache_hits = probed = early_used = 0
+    coverage = None
+
+    # 1. 归集要测试的 IP:port 和 URL：优先读 main.py 的结构化交接清单，缺失时回退解析链接文件
+    if handoff is not None:
+        ip_to_hostports, source = _handoff_targets(handoff), "内存交接"
+    else:
+        ip_to_hostports, source = _load_handoff(), HANDOFF_FILE
+    if ip_to_hostports is None:
+        ip_to_hostports, source = _parse_noncheck(), SOURCE_NONCHECK_FILE
+
+    if ip_to_hostports:
+        live_print(f"━━━ 🎬 抽样测速 ━━━━━━━━━━━━━━━━━━━━━━━━  🌐 {len(ip_to_hostports)} IP (async) ← {source}")
+        valid_hostports, logs = set(), []
+        meta_data = {}
 
-    if os.path.exists(SOURCE_NONCHECK_FILE):
-        with open(SOURCE_NONCHECK_FILE, encoding="utf-8") as f:
-            lines = [l.strip() for l in f if "," in l]
-
-        if lines:
-            # 1. 归集要测试的 IP:port 和 URL
-            ip_map, url_map = {}, {}
-            for line in lines:
-                try:
-                    url = line.split(",", 1)[1]
-                    host_port = url.split("/")[2]
-                    ip_key = host_port.split(":")[0]
-                    if ip_key not in ip_map: ip_map[ip_key] = []; url_map[ip_key] = []
-                    ip_map[ip_key].append(host_port)
-                    url_map[ip_key].append(url)
-                except (ValueError, IndexError): continue
-
-            live_print(f"━━━ 🎬 抽样测速 ━━━━━━━━━━━━━━━━━━━━━━━━  🌐 {len(ip_map)} IP (async)")
-            valid_hostports, logs = set(), []
-            meta_data = {}
-
-            # 构建 IP -> [(host_port, url_list), ...] 映射（同IP多端口并发）
-            ip_to_hostports = {}
-            for ip_key, urls in url_map.items():
-                ip_to_hostports[ip_key] = [(hp, urls) for hp in ip_map[ip_key]]
-
-            # 异步并发测速（同IP多端口并发 + 提前满足）
-            probe_workers = int(os.environ.get("PROBE_WORKERS", "50"))
-            sem = asyncio.Semaphore(probe_workers)
-            ip_found = set()  # 已找到有效端口的 IP，跳过剩余端口
+        # 异步并发测速（同IP多端口并发 + 提前满足）
+        probe_workers = int(os.environ.get("PROBE_WORKERS", "50"))
+        # 自适应并发窗口：PROBE_WORKERS 为初始值，PROBE_WORKERS_MAX 为上限（默认 4 倍）
+        probe_ctl = AdaptiveLimiter("probe", probe_workers,
+                                    maximum=int(os.environ.get("PROBE_WORKERS_MAX", probe_workers * 4)))
+        ip_found = set()  # 已找到有效端口的 IP，跳过剩余端口
+        rtp_entries = parse_rtp_entries(RTP_FILE)
+
+        # 测速缓存：TTL 内的成功结果直接复用（元数据沿用上次实测值与 probed_at），整 IP 跳过
+        probe_cache = _load_probe_cache() if PROBE_CACHE else {}
+        now = time.time()
+        for ip_key, hps in ip_to_hostports.items():
+            for hp, _ in hps:
+                if _cache_fresh(probe_cache, hp, now):
+                    rec = probe_cache[hp]
+                    valid_hostports.add(hp)
+                    meta_data[hp] = {k: rec.get(k) for k in META_FIELDS}
+                    meta_data[hp]["probed_at"] = rec["ts"]
+                    msg = f" 💾 [缓存] {hp:<21} | {rec.get('bandwidth_mbps', 0):.1f}Mbps | 连续 {rec['streak']} 次"
+                    live_print(msg, LOG_DETAIL)
+                    logs.append(msg.strip())
+                    ip_found.add(ip_key)
+                    break
+        cache_hits = len(ip_found)
+        if cache_hits:
+            live_print(f" 💾 缓存命中 {cache_hits} IP，实测 {len(ip_to_hostports) - cache_hits} IP")
+        
+        prefetched = prefetched if prefetched is not None else {}
+        monitor = LoopMonitor("probe", [probe_ctl])
+        async with (contextlib.nullcontext(client) if client is not None else new_probe_client()) as client:
+            monitor.start()
+            async def bounded_probe(hp, urls):
+                nonlocal early_used
+                early = prefetched.pop(hp, None)
+                if early is not None and not early.cancelled():
+                    # 扫描期间已提前测速：直接取结果，不占并发窗口；
+                    # 只有超时 / 连接失败可能是扫描期间拥塞所致，按正常流程重测，非 200 / 无流 / 非 TS 等结论直接采用
+                    res = await early
+                    if res[0] or not res[4].get("transient"):
+                        early_used += 1
+                        return res
+                    METRICS.incr("probe.early_retried")
+                async with probe_ctl:
+                    t0 = time.monotonic()
+                    res = await async_fast_ip_probe(client, hp, urls)
+                    # 失败且耗时触及 connect 超时 → 计为超时
+                    elapsed = time.monotonic() - t0
+                    probe_ctl.record(elapsed, timed_out=not res[0] and elapsed >= PROBE_TIMEOUT_AT)
+                    METRICS.observe("probe.host_ms", elapsed * 1000)
+                    return res
             
-            async with httpx.AsyncClient(
-                limits=httpx.Limits(max_keepalive_connections=300, max_connections=1000),
-                timeout=httpx.Timeout(connect=4, read=6, write=5, pool=2)
-            ) as client:
-                async def bounded_probe(hp, urls):
-                    async with sem:
-                        return await async_fast_ip_probe(client, hp, urls)
-                
-                # 滚动窗口并发（同IP多端口并发，任意端口成功后跳过该IP剩余端口）
-                pending = set()
-                all_ips = list(ip_to_hostports.items())  # [(ip, [(hp, urls), ...]), ...]
-                ip_idx = 0
-                hp_idx_per_ip = {}  # ip -> 当前测到第几个端口
+            # 滚动窗口并发（同IP多端口并发，任意端口成功后跳过该IP剩余端口）
+            probe_started = time.monotonic()
+            pending = set()
+            probed = 0
+            all_ips = [(ip, hps) for ip, hps in ip_to_hostports.items() if ip not in ip_found]  # [(ip, [(hp, urls), ...]), ...]
+            ip_idx = 0
+            hp_idx_per_ip = {}  # ip -> 当前测到第几个端口
+            
+            # 初始化：每个 IP 先测第一个端口
+            for ip, hps in all_ips[:probe_ctl.limit]:
+                if hps:
+                    hp, urls = hps[0]
+                    pending.add(asyncio.create_task(bounded_probe(hp, urls)))
+                    hp_idx_per_ip[ip] = 1
+            ip_idx = min(probe_ctl.limit, len(all_ips))
+            
+            while pending:
+                done, pending = await monitor.wait(pending)
+                for task in done:
+                    ok, hp, bw, msg, detail = task.result()
+                    ip = hp.split(":")[0]
+                    live_print(msg, LOG_DETAIL)
+                    logs.append(msg.strip())
+                    probed += 1
+                    # bandwidth_mbps 保持原字段名（下游排序用），语义为稳态吞吐
+                    meta = {"bandwidth_mbps": bw, "connect_ms": detail.get("connect_ms"),
+                            "ttfb_ms": detail.get("ttfb_ms"), "ts_mbps": detail.get("ts_mbps"),
+                            "cc_error_rate": detail.get("cc_error_rate")}
+                    _update_probe_cache(probe_cache, hp, ok, meta, time.time())
+                    METRICS.incr("probe.hosts_ok" if ok else "probe.hosts_fail")
+                    if ok:
+                        valid_hostports.add(hp)
+                        meta_data[hp] = dict(meta, probed_at=int(time.time()))
+                        ip_found.add(ip)  # 该 IP 已找到有效端口
                 
-                # 初始化：每个 IP 先测第一个端口
-                for ip, hps in all_ips[:probe_workers]:
-                    if hps:
-                        hp, urls = hps[0]
+                # 补充新任务（跳过已成功的 IP）
+                while len(pending) < probe_ctl.limit and ip_idx < len(all_ips):
+                    ip, hps = all_ips[ip_idx]
+                    # 如果该 IP 已成功，跳过剩余端口
+                    if ip in ip_found:
+                        ip_idx += 1
+                        continue
+                    # 测试该 IP 的下一个端口（如果还有）
+                    hp_idx = hp_idx_per_ip.get(ip, 0)
+                    if hp_idx < len(hps):
+                        hp, urls = hps[hp_idx]
                         pending.add(asyncio.create_task(bounded_probe(hp, urls)))
-                        hp_idx_per_ip[ip] = 1
-                ip_idx = min(probe_workers, len(all_ips))
-                
-                while pending:
-                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
-                    for task in done:
-                        ok, hp, bw, msg = task.result()
-                        ip = hp.split(":")[0]
-                        live_print(msg)
-                        logs.append(msg.strip())
-                        if ok:
-                            valid_hostports.add(hp)
-                            meta_data[hp] = {"bandwidth_mbps": bw}
-                            ip_found.add(ip)  # 该 IP 已找到有效端口
-                    
-                    # 补充新任务（跳过已成功的 IP）
-                    while len(pending) < probe_workers and ip_idx < len(all_ips):
-                        ip, hps = all_ips[ip_idx]
-                        # 如果该 IP 已成功，跳过剩余端口
-                        if ip in ip_found:
-                            ip_idx += 1
-                            continue
-                        # 测试该 IP 的下一个端口（如果还有）
-                        hp_idx = hp_idx_per_ip.get(ip, 0)
-                        if hp_idx < len(hps):
-                            hp, urls = hps[hp_idx]
-                            pending.add(asyncio.create_task(bounded_probe(hp, urls)))
-                            hp_idx_per_ip[ip] = hp_idx + 1
-                        else:
-                            # 该 IP 所有端口都测完了，下一个 IP
-                            ip_idx += 1
-
-            # 写入元数据供下游 m3u-checker-max 使用
-            if meta_data:
-                atomic_write(SOURCE_META_FILE, json.dumps(meta_data, ensure_ascii=False, indent=2))
-                live_print(f" 📝 服务器元数据已写入: {SOURCE_META_FILE} ({len(meta_data)} 台)")
-
-            # ==========================================
-            # 6. 重新拼装存活 IP 并写入 source-m3u.txt（标准 M3U 格式）
-            # ==========================================
-            live_print(f"━━━ 💾 数据重组与归档 ━━━━━━━━━━━━━━━━━━━━━")
-
-            # 先写日志
-            with open(LOG_FILE, "w", encoding="utf-8") as f:
-                f.write(f"服务器抽测报告 | 时间: {datetime.now()}\n" + "\n".join(sorted(logs)))
-            live_print(f" 📝 成功覆写日志: {LOG_FILE}")
-
-            # 读取 RTP 模板进行重新组装（RTP 解析与拼接改用 utils 公共函数）
-            rtp_entries = parse_rtp_entries(RTP_FILE)
-            if not valid_hostports:
-                # 没有存活 IP，清空文件
-                atomic_write(SOURCE_M3U_FILE, "")
-                live_print(f" 📝 存活 IP 为 0，已清空 {SOURCE_M3U_FILE}")
-            elif rtp_entries:
-                m3u_lines = build_m3u(rtp_entries, valid_hostports)
-                atomic_write(SOURCE_M3U_FILE, "\n".join(m3u_lines))
-                live_print(f" 📝 成功重组纯净版: {SOURCE_M3U_FILE} (标准M3U)")
-                live_print(f"✨ 测速结束: 存活 {len(valid_hostports)} 个 IP | 生成 {len(m3u_lines)-1} 条纯净链接")
+                        hp_idx_per_ip[ip] = hp_idx + 1
+                    else:
+                        # 该 IP 所有端口都测完了，下一个 IP
+                        ip_idx += 1
+
+            probe_seconds = time.monotonic() - probe_started
+            METRICS.add_time("phase.probe", probe_seconds)
+            if prefetched_metrics is not None:
+                # 提前测速的工作量与忙碌时间并入本段；速率按“测速活跃时间”（本阶段 + 扫描期间提前测速）计算
+                METRICS.merge(prefetched_metrics.snapshot())
+                prefetched_metrics.reset()
+            active_seconds = METRICS.seconds("phase.probe") + METRICS.seconds("phase.probe_early")
+            METRICS.gauge("probe.active_s", round(active_seconds, 2))
+            METRICS.gauge("probe.rate_per_s", round(probed / active_seconds, 2) if active_seconds > 0 else 0)
+
+            # 频道覆盖抽测：预算分摊到本轮存活服务器 × 轮转频道
+            if COVERAGE_BUDGET > 0 and valid_hostports and rtp_entries:
+                coverage = _load_coverage()
+                with METRICS.timer("phase.coverage"):
+                    coverage_tested, coverage_ok = await run_coverage(
+                        client, valid_hostports, rtp_entries, coverage, probe_ctl)
+                _save_coverage(coverage, int(time.time()))
+                live_print(f" 🧭 覆盖抽测: {coverage_ok}/{coverage_tested} 可用 → {COVERAGE_FILE}")
+            elif COVERAGE_STRICT:
+                coverage = _load_coverage()
+
+        probe_ctl.close()
+        concurrency_lines = probe_ctl.summary_lines()
+        monitor_lines = monitor.stop()
+
+        if PROBE_CACHE:
+            # 只保留本次输入中仍存在的服务器
+            inputs = {hp for hps in ip_to_hostports.values() for hp, _ in hps}
+            _save_probe_cache({hp: rec for hp, rec in probe_cache.items() if hp in inputs})
+
+        # 带宽分布（含缓存复用的服务器）→ 运行指标
+        bws = sorted(m["bandwidth_mbps"] or 0 for m in meta_data.values())
+        if bws:
+            for q in (10, 50, 90):
+                METRICS.gauge(f"probe.bandwidth_p{q}_mbps", bws[min(len(bws) - 1, len(bws) * q // 100)])
+            METRICS.gauge("probe.bandwidth_max_mbps", bws[-1])
+
+        # 写入元数据供下游 m3u-checker-max 使用
+        if meta_data:
+            atomic_write(SOURCE_META_FILE, json.dumps(meta_data, ensure_ascii=False, indent=2))
+            live_print(f" 📝 服务器元数据已写入: {SOURCE_META_FILE} ({len(meta_data)} 台)")
+
+        # ==========================================
+        # 6. 重新拼装存活 IP 并写入 source-m3u.txt（标准 M3U 格式）
+        # ==========================================
+        live_print(f"━━━ 💾 数据重组与归档 ━━━━━━━━━━━━━━━━━━━━━")
+        archive_started = time.monotonic()
+
+        # 先写日志
+        with open(LOG_FILE, "w", encoding="utf-8") as f:
+            f.write(f"服务器抽测报告 | 时间: {datetime.now()}\n" + "\n".join(sorted(logs)))
+        live_print(f" 📝 成功覆写日志: {LOG_FILE}")
+
+        # 读取 RTP 模板进行重新组装（RTP 解析与拼接改用 utils 公共函数）
+        if not valid_hostports:
+            # 没有存活 IP，清空文件
+            atomic_write(SOURCE_M3U_FILE, "")
+            drop_output_variants(SOURCE_M3U_FILE, SOURCE_COMPACT_FILE, OUTPUT_MANIFEST)
+            live_print(f" 📝 存活 IP 为 0，已清空 {SOURCE_M3U_FILE}")
+        elif rtp_entries:
+            # 有覆盖记录时剔除已知不可用的频道/服务器组合（strict 模式只保留已知可用）
+            pair_filter = coverage_filter(coverage) if coverage and coverage.get("servers") else None
+            link_count, changed_files = write_outputs([(SOURCE_M3U_FILE, "m3u")], rtp_entries, valid_hostports,
+                                                      pair_filter, compact=SOURCE_COMPACT_FILE, manifest=OUTPUT_MANIFEST)
+            if changed_files:
+                live_print(f" 📝 成功重组纯净版: {SOURCE_M3U_FILE} (标准M3U，{len(changed_files)} 个文件含压缩副本/紧凑表示)")
             else:
-                # 有存活 IP 但 RTP 模板缺失/为空：写入空 M3U 头，避免下游使用过期数据
-                atomic_write(SOURCE_M3U_FILE, "#EXTM3U\n")
-                live_print(f" ⚠️ RTP 模板为空或缺失 {RTP_FILE}，已写入空 M3U 头")
+                live_print(f" ℹ️ 纯净版内容未变，跳过改写: {SOURCE_M3U_FILE}")
+            live_print(f"✨ 测速结束: 存活 {len(valid_hostports)} 个 IP | 生成 {link_count} 条纯净链接")
+        else:
+            # 有存活 IP 但 RTP 模板缺失/为空：写入空 M3U 头，避免下游使用过期数据
+            atomic_write(SOURCE_M3U_FILE, "#EXTM3U\n")
+            drop_output_variants(SOURCE_M3U_FILE, SOURCE_COMPACT_FILE, OUTPUT_MANIFEST)
+            live_print(f" ⚠️ RTP 模板为空或缺失 {RTP_FILE}，已写入空 M3U 头", LOG_WARN)
+        METRICS.add_time("phase.archive", time.monotonic() - archive_started)
 
     # ==========================================
     # 7. 数据变动小结
     #    （下游仓库联动触发已统一移至 .github/workflows/main.yml，
-    #     此处仅汇报本次数据是否相较上次提交有变动）
+    #     此处仅汇报本次数据相较上次记录的变动及增减的服务器）
     # ==========================================
     live_print("\n⚖️ ========== 数据变动 ==========")
-    live_print(f"📌 source-ip.txt 相对上次提交: {'🆕 有变动' if changed else 'ℹ️ 无变动'}")
+    live_print(f"📌 source-ip.txt 相对上次记录: {'🆕 有变动' if changed else 'ℹ️ 无变动'}")
+    for icon, items in (("➕ 新增", added), ("➖ 消失", removed)):
+        if items:
+            more = f" …等 {len(items)} 台" if len(items) > CHANGE_LIST_LIMIT else ""
+            live_print(f"   {icon}: {', '.join(items[:CHANGE_LIST_LIMIT])}{more}")
     live_print("🔗 下游触发(m3u-checker-max / iptv-api)由 CI 统一处理")
 
     elapsed = round(time.time() - start_time, 2)
     # 无流/失败 IP 数：按 IP 维度统计（避免 IP 与 hostport 维度混用导致负值）
     ip_found_count = len(set(hp.split(":")[0] for hp in valid_hostports))
-    out_of_ip_count = max(0, len(ip_map) - ip_found_count)
+    out_of_ip_count = max(0, len(ip_to_hostports) - ip_found_count)
 
     log_section("测速 — 阶段摘要", "🎬")
     live_print(f"  源发现结果 → 抽样测速 → 数据变动")
     live_print(f"")
     live_print(f"  ┌─ 阶段: 测速结果")
-    live_print(f"  │  ├ 上游有效服务器 ..... {len(ip_map):>4} 个 (来自 source-ip.txt)")
+    live_print(f"  │  ├ 上游有效服务器 ..... {len(ip_to_hostports):>4} 个 (来自 source-ip.txt)")
     live_print(f"  │  ├ 有流响应 .......... {len(valid_hostports):>4} 个")
-    live_print(f"  │  └ 无流/失败 ......... {out_of_ip_count:>4} 个")
+    live_print(f"  │  ├ 无流/失败 ......... {out_of_ip_count:>4} 个")
+    if PROBE_CACHE:
+        live_print(f"  │  ├ 缓存命中/实测 ..... {cache_hits:>4} IP / {probed} 次")
+    if early_used:
+        live_print(f"  │  ├ 扫描期间提前测速 .. {early_used:>4} 个 (结果直接复用)")
+    if coverage_tested:
+        live_print(f"  │  ├ 频道覆盖抽测 ...... {coverage_ok:>4}/{coverage_tested} 可用{' (strict)' if COVERAGE_STRICT else ''}")
+    for line in monitor_lines:
+        live_print(f"  │  ├ 事件循环 .......... {line}")
+    live_print(f"  │  └ 并发窗口 .......... {concurrency_lines[0] if concurrency_lines else '-'}")
+    for line in concurrency_lines[1:]:
+        live_print(f"  │       {line}")
     live_print(f"  │")
     live_print(f"  └─ 阶段: 数据变动")
-    live_print(f"     ├ 本次数据: {'🆕 有变动' if changed else 'ℹ️ 无变动'}")
+    live_print(f"     ├ 本次数据: {'🆕 有变动' if changed else 'ℹ️ 无变动'} (+{len(added)} -{len(removed)})")
     live_print(f"     └ 耗时 ............. {elapsed:>7.2f}s")
     live_print(f"")
 
@@ -265,15 +836,38 @@ async def main():
     write_summary("### 🎬 阶段摘要 — 测速\n")
     write_summary("| 阶段 | 指标 | 数值 |")
     write_summary("|------|------|------|")
-    write_summary(f"| ① 测速 | 待测服务器 | {len(ip_map)} 个 |")
+    write_summary(f"| ① 测速 | 待测服务器 | {len(ip_to_hostports)} 个 |")
     write_summary(f"| ① 测速 | 有流响应 | {len(valid_hostports)} 个 |")
     write_summary(f"| ① 测速 | 无流/失败 | {out_of_ip_count} 个 |")
-    write_summary(f"| ② 数据变动 | source-ip | {'🆕 有变动' if changed else 'ℹ️ 无变动'} |")
+    if PROBE_CACHE:
+        write_summary(f"| ① 测速 | 缓存命中 / 实测 | {cache_hits} IP / {probed} 次 |")
+    if early_used:
+        write_summary(f"| ① 测速 | 扫描期间提前测速 | {early_used} 个 |")
+    if coverage_tested:
+        write_summary(f"| ① 测速 | 频道覆盖抽测 | {coverage_ok}/{coverage_tested} 可用 |")
+    if concurrency_lines:
+        write_summary(f"| ① 测速 | 并发窗口 | {concurrency_lines[0]} |")
+    for line in monitor_lines:
+        write_summary(f"| ① 测速 | 事件循环 | {line} |")
+    write_summary(f"| ② 数据变动 | source-ip | {'🆕 有变动' if changed else 'ℹ️ 无变动'} (+{len(added)} -{len(removed)}) |")
+    for label, items in (("新增服务器", added), ("消失服务器", removed)):
+        if items:
+            more = f" …等 {len(items)} 台" if len(items) > CHANGE_LIST_LIMIT else ""
+            write_summary(f"| ② 数据变动 | {label} | {', '.join(items[:CHANGE_LIST_LIMIT])}{more} |")
 
     write_summary(f"\n> ⏱️ 总耗时: {elapsed}s")
     write_summary(f"\n> 🔗 下游触发(m3u-checker-max / iptv-api)由 CI 统一处理")
 
+    # 运行指标（output/metrics.json 的 probe 段）
+    for key, value in (("elapsed_s", elapsed), ("hosts_input", len(ip_to_hostports)), ("hosts_valid", len(valid_hostports)),
+                       ("cache_hits", cache_hits), ("probed", probed), ("early_used", early_used),
+                       ("coverage_tested", coverage_tested), ("coverage_ok", coverage_ok),
+                       ("added", len(added)), ("removed", len(removed))):
+        METRICS.gauge(f"probe.{key}", value)
+    write_metrics("probe")
+
     live_print("\n✅ 测速完成，下游联动由 GitHub Actions 统一触发。")
+    return early_used
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,122 @@
+"""get-m3u 统一入口：源发现 + 质量探测在同一进程、同一事件循环内完成。
+
+- 扫描与测速各用一个 httpx.AsyncClient（各自的超时与连接池，扫描不占测速连接），整个运行只建一次
+- 扫描确认命中的服务器立即提前测速（与扫描并行），测速阶段直接取结果，超时 / 连接失败的按正常流程重测
+- 交接清单在内存中传递，仍照常写出 output/ 下所有文件，main.py / probe.py 也可单独运行
+"""
+import os, time, asyncio, argparse
+import main as discovery
+import probe
+from utils import live_print, write_summary, log_section, parse_rtp_entries, AdaptiveLimiter, Metrics, METRICS, write_metrics
+
+# 提前测速并发上限：与扫描并行，默认取测速并发的一半，避免挤占扫描带宽
+EARLY_PROBE_WORKERS = int(os.environ.get("EARLY_PROBE_WORKERS", int(os.environ.get("PROBE_WORKERS", "50")) // 2))
+
+
+class EarlyProber:
+    """扫描命中回调 → 后台提前测速；结果以 {hp: Task} 交给 probe.main(prefetched=...)。
+
+    提前测速的字节数 / 时延记入独立的 self.metrics（不混进 main 段），并记录扫描期间
+    至少有一个提前测速在途的忙碌时间，由 probe.main(prefetched_metrics=...) 并入 probe 段。"""
+
+    def __init__(self, client):
+        self.client = client
+        self.tasks = {}
+        self.metrics = Metrics()
+        self.limiter = AdaptiveLimiter("probe-early", max(1, EARLY_PROBE_WORKERS), metrics=self.metrics)
+        self._in_flight = 0
+        self._busy_since = None
+        self._busy_closed = False
+        self.cache = probe._load_probe_cache() if probe.PROBE_CACHE else {}
+        self._rtp_ids = None
+        self._now = time.time()
+
+    def on_hit(self, ip_port):
+        if ip_port in self.tasks or probe._cache_fresh(self.cache, ip_port, self._now):
+            return  # 缓存仍有效的服务器交给 probe.main 直接复用
+        if self._rtp_ids is None:
+            # main.main 在扫描前已更新 RTP 模板
+            self._rtp_ids = [suffix for _, suffix in parse_rtp_entries(probe.RTP_FILE)]
+        if not self._rtp_ids:
+            return
+        self.tasks[ip_port] = asyncio.create_task(self._probe(ip_port))
+
+    async def _probe(self, ip_port):
+        async with self.limiter:
+            t0 = time.monotonic()
+            if self._in_flight == 0 and not self._busy_closed:
+                self._busy_since = t0
+            self._in_flight += 1
+            try:
+                res = await probe.async_fast_ip_probe(self.client, ip_port, probe.probe_urls(ip_port, self._rtp_ids),
+                                                      metrics=self.metrics)
+            finally:
+                self._in_flight -= 1
+                if self._in_flight == 0 and self._busy_since is not None:
+                    self.metrics.add_time("phase.probe_early", time.monotonic() - self._busy_since)
+                    self._busy_since = None
+            elapsed = time.monotonic() - t0
+            self.limiter.record(elapsed, timed_out=not res[0] and elapsed >= probe.PROBE_TIMEOUT_AT)
+            self.metrics.observe("probe.host_ms", elapsed * 1000)
+            return res
+
+    def close_busy(self):
+        """测速阶段开始时截断忙碌计时：此后仍在途的提前测速与测速阶段重叠，由 phase.probe 覆盖"""
+        if self._busy_since is not None:
+            self.metrics.add_time("phase.probe_early", time.monotonic() - self._busy_since)
+            self._busy_since = None
+        self._busy_closed = True
+
+    def discard(self, keep=None):
+        """取消并移除 keep 之外的任务，返回移除数。
+
+        测速前以交接清单为 keep 调用（未通过归属复核的服务器不再占用提前测速窗口），
+        无参调用移除全部任务（见 close）。"""
+        keep = set(keep or ())
+        dropped = [hp for hp in self.tasks if hp not in keep]
+        for hp in dropped:
+            task = self.tasks.pop(hp)
+            if not task.done():
+                task.cancel()
+        return len(dropped)
+
+    def close(self):
+        unused = self.discard()
+        self.limiter.close()
+        return unused
+
+
+async def run(shards=None):
+    start_time = time.time()
+    async with discovery.new_scan_client() as scan_client, probe.new_probe_client() as client:
+        early = EarlyProber(client)
+        handoff = await discovery.main(shards=shards, client=scan_client, on_hit=early.on_hit)
+        started = len(early.tasks)
+        unused = early.discard(keep=handoff["hostports"] if handoff else ())
+        early.close_busy()
+        used = await probe.main(client=client, handoff=handoff, prefetched=early.tasks, prefetched_metrics=early.metrics)
+        unused += early.close()
+    retried = started - unused - used
+
+    elapsed = round(time.time() - start_time, 2)
+    log_section("统一运行 — 摘要", "🚀")
+    live_print(f"  提前测速: 启动 {started} 个 | 复用 {used} 个 | 超时重测 {retried} 个 | 未使用 {unused} 个")
+    live_print(f"  总耗时: {elapsed:.2f}s")
+    write_summary("### 🚀 统一运行\n")
+    write_summary("| 指标 | 数值 |")
+    write_summary("|------|------|")
+    write_summary(f"| 提前测速 启动 / 复用 / 超时重测 / 未使用 | {started} / {used} / {retried} / {unused} |")
+    write_summary(f"| 总耗时 | {elapsed}s |")
+
+    # 提前测速的字节数 / 时延记在 main 段（发生在扫描期间），这里只补充整体数据
+    for key, value in (("early_started", started), ("early_used", used), ("early_retried", retried),
+                       ("early_unused", unused), ("elapsed_s", elapsed)):
+        METRICS.gauge(f"run.{key}", value)
+    write_metrics("run")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="统一入口：源发现 + 质量探测（单进程、单事件循环、提前测速）")
+    parser.add_argument("--shards", type=int, default=discovery.SCAN_SHARDS,
+                        help="全量扫描分片进程数（1=单进程，0=按 CPU 核数；默认读 SCAN_SHARDS）")
+    asyncio.run(run(shards=parser.parse_args().shards))
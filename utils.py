@@ -1,10 +1,147 @@
 """get-m3u 公共工具模块"""
-import os, sys, tempfile
+import os, sys, time, asyncio, tempfile, gzip, hashlib, json, bisect, functools, queue, threading, atexit
+from contextlib import contextmanager
+from itertools import islice, chain
+
+try:
+    import zstandard  # 可选：输出 .zst 压缩副本
+except ImportError:
+    zstandard = None
 
 SUMMARY_FILE = os.environ.get("GITHUB_STEP_SUMMARY", "")
 
-def live_print(content):
-    print(content, flush=True, file=sys.stderr)
+# ===============================
+# 日志：后台写线程 + 有界队列（事件循环内 live_print 只入队，不做 stderr 写调用）
+# ===============================
+LOG_DETAIL, LOG_INFO, LOG_WARN = 10, 20, 30   # 逐条明细（命中 / 单次测速 / 单段校验）/ 阶段与摘要 / 告警
+LOG_LEVELS = {"detail": LOG_DETAIL, "info": LOG_INFO, "warn": LOG_WARN}
+# LOG_LEVEL=info 为安静模式：不输出逐条明细，保留阶段标题、进度与摘要
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get("LOG_LEVEL", "detail").strip().lower(), LOG_DETAIL)
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))          # 明细行超过此积压即丢弃（计数，写出汇总行）
+LOG_RESERVED_SLOTS = 1000                                               # 队列为 info / warn 额外预留的槽位，满了也只丢弃不等待
+LOG_PROGRESS_INTERVAL = float(os.environ.get("LOG_PROGRESS_INTERVAL", "5"))  # 进度行最小输出间隔（秒）
+LOG_BATCH_LINES = 512                                                   # 写线程每次合并写出的最大行数
+
+
+class _LogWriter:
+    """后台写线程：批量取出队列中的行，一次 write + flush。每个进程（含分片子进程）首次写日志时懒启动"""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE + LOG_RESERVED_SLOTS)
+        self.dropped = 0       # 丢弃的明细行
+        self.dropped_info = 0  # 预留槽位也用尽时丢弃的 info / warn 行
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            lines = [self.queue.get()]
+            while len(lines) < LOG_BATCH_LINES:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in lines:
+                stop = True
+                lines = [line for line in lines if line is not None]
+            if self.dropped or self.dropped_info:
+                lines.append(f"⚠️ 日志队列已满，丢弃 {self.dropped} 行明细 / {self.dropped_info} 行常规日志")
+                self.dropped = self.dropped_info = 0
+            try:
+                if lines:
+                    sys.stderr.write("\n".join(lines) + "\n")
+                sys.stderr.flush()
+            except (OSError, ValueError):
+                pass
+
+    def put(self, line, level):
+        # 调用方是事件循环线程，任何级别都不阻塞：明细行只用前 LOG_QUEUE_SIZE 个槽位，其余级别可用预留槽位
+        if level <= LOG_DETAIL and self.queue.qsize() >= LOG_QUEUE_SIZE:
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            if level <= LOG_DETAIL:
+                self.dropped += 1
+            else:
+                self.dropped_info += 1
+
+    def close(self, timeout=5):
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+
+_log_writer = None
+_log_lock = threading.Lock()
+_log_hooks_installed = False
+
+
+def _start_log_writer():
+    global _log_writer, _log_hooks_installed
+    with _log_lock:
+        if _log_writer is None:
+            _log_writer = _LogWriter()
+            if not _log_hooks_installed:
+                _log_hooks_installed = True
+                atexit.register(flush_logs)
+                if sys.excepthook is sys.__excepthook__:
+                    sys.excepthook = _flush_then_excepthook
+    return _log_writer
+
+
+def _reset_log_writer_in_child():
+    # fork 出的子进程（分片扫描）不继承写线程：丢弃父进程的 writer 与可能被持有的锁，首次写日志时重建
+    global _log_writer, _log_lock
+    _log_writer = None
+    _log_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_log_writer_in_child)
+
+
+def _flush_then_excepthook(*exc_info):
+    # 未捕获异常：先写完已排队的日志，保证 traceback 出现在最后
+    flush_logs()
+    sys.__excepthook__(*exc_info)
+
+
+def flush_logs():
+    """写出队列中剩余日志并停止写线程（进程退出时自动调用；子进程在返回结果前手动调用）"""
+    global _log_writer
+    with _log_lock:
+        writer, _log_writer = _log_writer, None
+    if writer is not None:
+        writer.close()
+
+
+def live_print(content, level=LOG_INFO):
+    """日志输出到 stderr：低于 LOG_LEVEL 的级别直接丢弃，其余交给后台写线程"""
+    if level >= LOG_LEVEL:
+        (_log_writer or _start_log_writer()).put(content, level)
+
+
+_progress_at = {}
+
+
+def live_progress(key, build):
+    """限频进度：同一 key 距上次输出（首次调用时从该时刻起算）不足 LOG_PROGRESS_INTERVAL 秒则跳过；
+    build() 返回文本，跳过时不构造"""
+    now = time.monotonic()
+    last = _progress_at.setdefault(key, now)
+    if now - last >= LOG_PROGRESS_INTERVAL:
+        _progress_at[key] = now
+        live_print(build())
+
+
+def reset_progress(key):
+    """新一轮任务开始时调用，进度间隔从此刻重新计时"""
+    _progress_at.pop(key, None)
 
 def write_summary(content):
     """写入 GitHub Actions Job Summary（Markdown 格式，仅 GitHub 环境生效）"""
@@ -34,6 +171,40 @@ def atomic_write(filepath, content):
         raise
 
 
+WRITE_BATCH_LINES = 4096  # 流式写入每批拼接的行数（批内 join 一次，兼顾内存与写调用次数）
+
+
+def atomic_write_lines(filepath, lines):
+    """流式原子化写入：逐批消费可迭代的行并写入临时文件，再 rename。
+
+    输出与 atomic_write(filepath, "\n".join(lines)) 完全一致（行间换行、末尾无换行），
+    但内存只占一批行，适合 iter_m3u / iter_compat 这类 servers × channels 生成器。
+    返回写入的行数。
+    """
+    dir_path = os.path.dirname(filepath) or '.'
+    tmp = tempfile.NamedTemporaryFile(mode='w', encoding='utf-8',
+                                      dir=dir_path, delete=False, suffix='.tmp')
+    count = 0
+    try:
+        it = iter(lines)
+        while True:
+            batch = list(islice(it, WRITE_BATCH_LINES))
+            if not batch:
+                break
+            if count:
+                tmp.write("\n")
+            tmp.write("\n".join(batch))
+            count += len(batch)
+        tmp.close()
+        os.replace(tmp.name, filepath)
+    except Exception:
+        tmp.close()
+        try: os.unlink(tmp.name)
+        except OSError: pass
+        raise
+    return count
+
+
 def parse_rtp_entries(rtp_file):
     """读取 RTP 模板文件，返回 [(name, suffix), ...]，suffix 形如 '239.77.1.234:5146'。
 
@@ -57,30 +228,792 @@ def parse_rtp_entries(rtp_file):
     return entries
 
 
-def build_m3u(rtp_entries, hostports):
-    """由 RTP 条目与 hostport 集合拼出标准 M3U 行列表（含 #EXTM3U 头）。
+def iter_m3u(rtp_entries, hostports, pair_filter=None):
+    """按需产出标准 M3U 行（含 #EXTM3U 头），不在内存中物化 servers × channels 全集。
 
     - rtp_entries: parse_rtp_entries() 的返回值 [(name, suffix), ...]
     - hostports: 可迭代的 'ip:port' 字符串
-    返回如 ["#EXTM3U", "#EXTINF:-1,频道名", "http://ip:port/rtp/suffix", ...]
+    - pair_filter: 可选 (hp, suffix) -> bool，返回 False 的组合不输出（如频道覆盖抽测判定不可用）
+    依次产出 "#EXTM3U", "#EXTINF:-1,频道名", "http://ip:port/rtp/suffix", ...
     """
-    lines = ["#EXTM3U"]
+    yield "#EXTM3U"
+    # 频道名行与 URL 前缀只依赖频道，预先拼好避免在内层循环重复格式化
+    extinf = [(f"#EXTINF:-1,{name}", suffix) for name, suffix in rtp_entries]
+    for hp in sorted(hostports):
+        prefix = f"http://{hp}/rtp/"
+        for info, suffix in extinf:
+            if pair_filter is not None and not pair_filter(hp, suffix):
+                continue
+            yield info
+            yield prefix + suffix
+
+
+def iter_compat(rtp_entries, hostports):
+    """按需产出兼容格式行（'频道名,http://ip:port/rtp/suffix'），参数同 iter_m3u"""
     for hp in sorted(hostports):
+        prefix = f"http://{hp}/rtp/"
         for name, suffix in rtp_entries:
-            lines.append(f"#EXTINF:-1,{name}")
-            lines.append(f"http://{hp}/rtp/{suffix}")
-    return lines
+            yield f"{name},{prefix}{suffix}"
+
+
+def build_m3u(rtp_entries, hostports, pair_filter=None):
+    """由 RTP 条目与 hostport 集合拼出标准 M3U 行列表（含 #EXTM3U 头）。
+
+    列表版本，等价于 list(iter_m3u(...))；写文件请用 iter_m3u + atomic_write_lines 流式输出。
+    返回如 ["#EXTM3U", "#EXTINF:-1,频道名", "http://ip:port/rtp/suffix", ...]
+    """
+    return list(iter_m3u(rtp_entries, hostports, pair_filter))
 
 
 def build_compat(rtp_entries, hostports):
     """由 RTP 条目与 hostport 集合拼出兼容格式行（'频道名,http://ip:port/rtp/suffix'）。
 
-    供 main.py 与 probe.py 共用，避免两处重复拼接逻辑。
-    - rtp_entries: parse_rtp_entries() 的返回值 [(name, suffix), ...]
-    - hostports: 可迭代的 'ip:port' 字符串
+    列表版本，等价于 list(iter_compat(...))；写文件请用 iter_compat + atomic_write_lines 流式输出。
     """
-    lines = []
-    for hp in sorted(hostports):
-        for name, suffix in rtp_entries:
-            lines.append(f"{name},http://{hp}/rtp/{suffix}")
-    return lines
+    return list(iter_compat(rtp_entries, hostports))
+
+
+# 单次遍历多格式写出：每条记录由频道前缀与 URL 组成，频道前缀按格式预先拼好
+# fmt -> (文件头行或 None, name -> 频道前缀, 前缀是否独占一行)
+# 独占一行时前缀与 URL 交错进缓冲区，不再逐条拼接字符串
+OUTPUT_FORMATS = {
+    "m3u": ("#EXTM3U", lambda name: f"#EXTINF:-1,{name}", True),
+    "compat": (None, lambda name: f"{name},", False),
+}
+
+# 压缩副本：每个目标额外写出 <文件>.gz / <文件>.zst（gzip 固定 mtime=0，内容不变则字节不变）
+# zstd 为可选依赖：未安装 zstandard 时跳过 .zst
+# 置空（OUTPUT_COMPRESS=）即不写压缩副本
+OUTPUT_COMPRESS_CHOICES = ("gz", "zst")
+OUTPUT_COMPRESS = [v for v in (v.strip().lower() for v in os.environ.get("OUTPUT_COMPRESS", "gz,zst").split(",")) if v]
+if any(v not in OUTPUT_COMPRESS_CHOICES for v in OUTPUT_COMPRESS):
+    live_print(f"⚠️ 忽略未知 OUTPUT_COMPRESS 项: {', '.join(v for v in OUTPUT_COMPRESS if v not in OUTPUT_COMPRESS_CHOICES)}"
+               f"（可选 {'/'.join(OUTPUT_COMPRESS_CHOICES)}）", LOG_WARN)
+    OUTPUT_COMPRESS = [v for v in OUTPUT_COMPRESS if v in OUTPUT_COMPRESS_CHOICES]
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 12
+
+
+def _compress_writer(tmp, ext):
+    """在临时文件上套一层压缩流；返回的对象 close() 时不关闭 tmp"""
+    if ext == "gz":
+        return gzip.GzipFile(filename="", mode="wb", fileobj=tmp, mtime=0, compresslevel=GZIP_LEVEL)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(tmp, closefd=False)
+
+
+def load_manifest(manifest_file):
+    """读取输出清单 {文件名: {"content_sha256", "size", "updated_at"}}；缺失或损坏时返回空字典。
+
+    content_sha256 为未压缩内容的哈希（压缩副本与原文件相同），下游可先比对清单再决定是否下载。
+    """
+    try:
+        with open(manifest_file, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest_file, manifest):
+    atomic_write(manifest_file, json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True) + "\n")
+
+
+class _LineSink:
+    """write_outputs 的单个格式：一份行缓冲 + 内容哈希，同时写入原文件与各压缩副本的临时文件。
+
+    频道前缀在构造时一次性编码为 UTF-8，写出阶段只做 bytes 拼接，避免逐批重复编码中文频道名。
+    """
+
+    def __init__(self, filepath, fmt, rtp_entries, compress):
+        header, entry_prefix, self.own_line = OUTPUT_FORMATS[fmt]
+        self.prefixes = [entry_prefix(name).encode("utf-8") for name, _ in rtp_entries]
+        self.buf = [header.encode("utf-8")] if header is not None else []
+        self.started = False
+        self.hasher = hashlib.sha256()
+        self.files = []  # [(目标路径, 临时文件, 写入对象)]
+        for ext in [None] + list(compress):
+            path = filepath if ext is None else f"{filepath}.{ext}"
+            tmp = tempfile.NamedTemporaryFile(mode='wb', dir=os.path.dirname(path) or '.',
+                                              delete=False, suffix='.tmp')
+            self.files.append((path, tmp, tmp if ext is None else _compress_writer(tmp, ext)))
+
+    def add(self, idx, urls):
+        pre = self.prefixes if idx is None else [self.prefixes[i] for i in idx]
+        if self.own_line:
+            self.buf.extend(chain.from_iterable(zip(pre, urls)))
+        else:
+            self.buf.extend(map(bytes.__add__, pre, urls))
+        if len(self.buf) >= WRITE_BATCH_LINES:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            data = b"\n".join(self.buf)
+            if self.started:
+                data = b"\n" + data
+            self.hasher.update(data)
+            for _, _, writer in self.files:
+                writer.write(data)
+            self.started = True
+            self.buf = []
+
+    def close(self):
+        self.flush()
+        for _, tmp, writer in self.files:
+            if writer is not tmp:
+                writer.close()
+            tmp.close()
+
+    def discard(self):
+        for _, tmp, _ in self.files:
+            tmp.close()
+            try: os.unlink(tmp.name)
+            except OSError: pass
+
+
+def drop_output_variants(filepath, compact=None, manifest=None):
+    """原文件被 write_outputs 以外的方式改写（如清空）后调用：删除其压缩副本与紧凑表示，并从清单移除，
+    避免下游读到过期副本、也避免下次因清单哈希相同而误判未变"""
+    paths = [filepath] + [f"{filepath}.{ext}" for ext in ("gz", "zst")] + ([compact] if compact else [])
+    for path in paths[1:]:
+        try: os.unlink(path)
+        except OSError: pass
+    if manifest:
+        entries = load_manifest(manifest)
+        removed = [entries.pop(os.path.basename(path), None) for path in paths]
+        if any(removed):
+            save_manifest(manifest, entries)
+
+
+def build_compact(rtp_entries, hostports, excluded=None):
+    """紧凑表示：频道模板 + 服务器列表（+ 被剔除组合），下游用 expand_compact 展开为任一格式"""
+    return {
+        "version": 1,
+        "formats": {fmt: {"header": header, "prefix": entry_prefix("{name}"), "own_line": own_line}
+                    for fmt, (header, entry_prefix, own_line) in OUTPUT_FORMATS.items()},
+        "url": "http://{hostport}/rtp/{suffix}",
+        "channels": [[name, suffix] for name, suffix in rtp_entries],
+        "hostports": sorted(hostports),
+        "excluded": excluded or {},  # {hostport: [频道下标, ...]}
+    }
+
+
+def expand_compact(compact, fmt):
+    """按 build_compact 的数据展开出与 write_outputs 相同的行（生成器）"""
+    spec = compact["formats"][fmt]
+    if spec["header"] is not None:
+        yield spec["header"]
+    for hp in compact["hostports"]:
+        skip = set(compact["excluded"].get(hp, ()))
+        for i, (name, suffix) in enumerate(compact["channels"]):
+            if i in skip:
+                continue
+            prefix = spec["prefix"].replace("{name}", name)
+            url = compact["url"].replace("{hostport}", hp).replace("{suffix}", suffix)
+            if spec["own_line"]:
+                yield prefix
+                yield url
+            else:
+                yield prefix + url
+
+
+def write_outputs(targets, rtp_entries, hostports, pair_filter=None, compact=None, manifest=None):
+    """一次遍历 hostports × rtp_entries，同时写出多个格式的文件及其压缩副本。
+
+    - targets: [(filepath, fmt), ...]，fmt 为 OUTPUT_FORMATS 的键（"m3u" / "compat"）
+    - pair_filter: 可选 (hp, suffix) -> bool，对所有目标生效
+    - compact: 可选路径，额外写出 build_compact 紧凑表示（JSON）
+    - manifest: 可选输出清单路径；内容哈希与清单一致且文件都在时不替换（原文件与压缩副本都不动）
+    每个 URL 只拼一次、供所有目标共用；各文件独立写临时文件，全部成功后逐个 rename（单文件原子），
+    任一失败则清理全部临时文件、不替换任何目标。输出与 iter_m3u / iter_compat + atomic_write_lines 一致。
+    返回 (写入的组合数, 实际改写的文件列表)。
+    """
+    compress = [ext for ext in OUTPUT_COMPRESS if ext != "zst" or zstandard is not None]
+    sinks = []
+    excluded = {}
+    try:
+        for filepath, fmt in targets:
+            sinks.append(_LineSink(filepath, fmt, rtp_entries, compress))
+        suffixes = [suffix for _, suffix in rtp_entries]
+        suffix_bytes = [suffix.encode("utf-8") for suffix in suffixes]
+        count = 0
+        for hp in sorted(hostports):
+            prefix = f"http://{hp}/rtp/".encode("utf-8")
+            if pair_filter is None:
+                idx, urls = None, [prefix + suffix for suffix in suffix_bytes]
+            else:
+                idx = [i for i, suffix in enumerate(suffixes) if pair_filter(hp, suffix)]
+                urls = [prefix + suffix_bytes[i] for i in idx]
+                if len(idx) < len(suffixes):
+                    kept = set(idx)
+                    excluded[hp] = [i for i in range(len(suffixes)) if i not in kept]
+            for sink in sinks:
+                sink.add(idx, urls)
+            count += len(urls)
+        for sink in sinks:
+            sink.close()
+    except Exception:
+        for sink in sinks:
+            sink.discard()
+        raise
+
+    entries = load_manifest(manifest) if manifest else {}
+    now, changed = int(time.time()), []
+
+    def _unchanged(path, digest):
+        rec = entries.get(os.path.basename(path))
+        return rec is not None and rec.get("content_sha256") == digest and os.path.exists(path)
+
+    for sink in sinks:
+        digest = sink.hasher.hexdigest()
+        if manifest and all(_unchanged(path, digest) for path, _, _ in sink.files):
+            sink.discard()
+            continue
+        for path, tmp, _ in sink.files:
+            os.replace(tmp.name, path)
+            entries[os.path.basename(path)] = {"content_sha256": digest, "size": os.path.getsize(path), "updated_at": now}
+            changed.append(path)
+    if compact:
+        content = json.dumps(build_compact(rtp_entries, hostports, excluded), ensure_ascii=False,
+                             separators=(",", ":")) + "\n"
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        if not (manifest and _unchanged(compact, digest)):
+            atomic_write(compact, content)
+            entries[os.path.basename(compact)] = {"content_sha256": digest, "size": os.path.getsize(compact), "updated_at": now}
+            changed.append(compact)
+    if manifest and changed:
+        save_manifest(manifest, entries)
+    return count, changed
+
+
+# ===============================
+# 运行指标（计时 / 计数 / 直方图）→ output/metrics.json
+# ===============================
+METRICS_FILE = "output/metrics.json"
+# 直方图桶上界（毫秒，对数刻度）；最后一桶为溢出桶
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        """按桶估算分位数：返回所在桶上界（不超过实测 max）"""
+        if not self.count:
+            return None
+        target, seen = q * self.count, 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and i < len(HISTOGRAM_BOUNDS_MS):
+                return min(HISTOGRAM_BOUNDS_MS[i], round(self.max, 1))
+        return round(self.max, 1)
+
+    def snapshot(self):
+        return {"count": self.count, "mean": round(self.total / self.count, 1) if self.count else None,
+                "min": None if self.min is None else round(self.min, 1),
+                "max": None if self.max is None else round(self.max, 1),
+                "p50": self.percentile(0.5), "p90": self.percentile(0.9), "p99": self.percentile(0.99),
+                "bounds_ms": list(HISTOGRAM_BOUNDS_MS), "buckets": list(self.buckets)}
+
+    def merge(self, snap):
+        self.buckets = [a + b for a, b in zip(self.buckets, snap["buckets"])]
+        self.count += snap["count"]
+        self.total += (snap["mean"] or 0) * snap["count"]
+        for attr, pick in (("min", min), ("max", max)):
+            if snap[attr] is not None:
+                cur = getattr(self, attr)
+                setattr(self, attr, snap[attr] if cur is None else pick(cur, snap[attr]))
+
+
+class Metrics:
+    """进程内运行指标：阶段计时（累计秒数/次数）、计数器、瞬时值、毫秒直方图。
+
+    - with METRICS.timer("phase.scan"): ... 或 @timed("phase.scan") 装饰同步/异步函数
+    - METRICS.incr("scan.hits") / METRICS.gauge("scan.rate_per_s", v) / METRICS.observe("probe.ttfb_ms", ms)
+    - snapshot() 导出为 dict；merge() 合并子进程（分片扫描）的 snapshot
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @contextmanager
+    def timer(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def add_time(self, name, seconds):
+        """记入一段已测得的耗时（不便用 with 包裹的阶段）"""
+        rec = self.timers.setdefault(name, [0.0, 0])
+        rec[0] += seconds
+        rec[1] += 1
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value_ms):
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = _Histogram()
+        hist.observe(value_ms)
+
+    def seconds(self, name):
+        return self.timers.get(name, (0.0, 0))[0]
+
+    def snapshot(self):
+        return {
+            "timers": {k: {"seconds": round(v[0], 3), "count": v[1]} for k, v in sorted(self.timers.items())},
+            "counters": dict(sorted(self.counters.items())),
+            "gauges": dict(sorted(self.gauges.items())),
+            "histograms": {k: v.snapshot() for k, v in sorted(self.histograms.items())},
+        }
+
+    def merge(self, snap, timers=True):
+        """合并另一份 snapshot；timers=False 时跳过计时（并行子进程的阶段耗时相加没有意义）"""
+        for k, v in (snap.get("timers", {}) if timers else {}).items():
+            rec = self.timers.setdefault(k, [0.0, 0])
+            rec[0] += v["seconds"]
+            rec[1] += v["count"]
+        for k, v in snap.get("counters", {}).items():
+            self.incr(k, v)
+        for k, v in snap.get("histograms", {}).items():
+            self.histograms.setdefault(k, _Histogram()).merge(v)
+
+
+METRICS = Metrics()
+
+
+def timed(name):
+    """装饰器：把函数每次调用的墙钟耗时记入 METRICS.timer(name)，同时支持同步与 async 函数"""
+    def deco(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with METRICS.timer(name):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with METRICS.timer(name):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def write_metrics(section, metrics=METRICS, path=METRICS_FILE, history=None):
+    """把当前指标写入 metrics.json 的 section（"main" / "probe" / "run"），保留其他 section；写完清零，
+    单进程 run.py 模式下各阶段互不串扰。同时把压缩行追加进历史（history 默认 METRICS_HISTORY_FILE，
+    传 False 不记录）并报告相对滚动基线的回归"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    snap = dict(metrics.snapshot(), recorded_at=int(time.time()))
+    data["version"] = 1
+    data[section] = snap
+    atomic_write(path, json.dumps(data, ensure_ascii=False, indent=1, sort_keys=True) + "\n")
+    metrics.reset()
+    if history is not False:
+        row = metrics_row(section, snap)
+        rows = append_metrics_history(row, history or METRICS_HISTORY_FILE)
+        report_regressions(find_regressions(rows[:-1], row))
+
+
+# ===============================
+# 运行指标历史（环形缓冲）+ 回归检测
+# ===============================
+METRICS_HISTORY_FILE = "data/metrics-history.jsonl"
+METRICS_HISTORY_LIMIT = int(os.environ.get("METRICS_HISTORY_LIMIT", "240"))    # 每段保留最近 N 次（3h 一次 ≈ 30 天）
+METRICS_BASELINE_RUNS = int(os.environ.get("METRICS_BASELINE_RUNS", "10"))     # 滚动基线：同段最近 N 次的中位数
+METRICS_BASELINE_MIN = 3                                                       # 基线样本不足时不判定
+METRICS_REGRESSION_PCT = float(os.environ.get("METRICS_REGRESSION_PCT", "25"))  # 劣化超过基线的百分比视为回归
+# 回归监测项：(段, 键, 方向, 最小劣化量)；方向 1 = 越大越差（耗时，秒），-1 = 越小越差（速率）；
+# 最小劣化量过滤短耗时的抖动（如 0.6s → 0.8s 不算回归）
+REGRESSION_WATCH = (
+    ("main", "phase.scan", 1, 5),
+    ("main", "phase.scan_sharded", 1, 5),
+    ("main", "scan.rate_per_s", -1, 0),
+    ("main", "main.elapsed_s", 1, 10),
+    ("probe", "probe.active_s", 1, 1),  # 测速活跃时间（含 run.py 扫描期间的提前测速），两种运行方式口径一致
+    ("probe", "probe.rate_per_s", -1, 0),
+    ("probe", "probe.elapsed_s", 1, 2),
+)
+
+
+def metrics_row(section, snap):
+    """把 snapshot 压平成一行：计时取秒数、计数器与瞬时值原样、直方图取 p50 / p99"""
+    values = {k: v["seconds"] for k, v in snap["timers"].items()}
+    values.update(snap["counters"])
+    values.update(snap["gauges"])
+    for k, v in snap["histograms"].items():
+        values[f"{k}.p50"], values[f"{k}.p99"] = v["p50"], v["p99"]
+    return {"ts": snap["recorded_at"], "section": section, "values": values}
+
+
+def load_metrics_history(path=METRICS_HISTORY_FILE):
+    """读取历史（JSON Lines，每行一次运行的一个段），按时间顺序返回；损坏行跳过"""
+    rows = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return rows
+
+
+def append_metrics_history(row, path=METRICS_HISTORY_FILE, limit=None):
+    """追加一行并按段裁剪到最近 limit 行（环形缓冲）；每行独立一行 JSON，git diff 只有增删的行"""
+    limit = METRICS_HISTORY_LIMIT if limit is None else limit
+    rows = load_metrics_history(path) + [row]
+    kept, seen = [], {}
+    for r in reversed(rows):
+        seen[r["section"]] = seen.get(r["section"], 0) + 1
+        if seen[r["section"]] <= limit:
+            kept.append(r)
+    kept.reverse()
+    atomic_write(path, "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":"), sort_keys=True) + "\n"
+                               for r in kept))
+    return kept
+
+
+def find_regressions(history, row):
+    """row 相对 history 中同段最近 METRICS_BASELINE_RUNS 次中位数的劣化项：[(键, 当前值, 基线, 劣化百分比)]"""
+    past = [r["values"] for r in history if r["section"] == row["section"]]
+    regressions = []
+    for section, key, direction, min_delta in REGRESSION_WATCH:
+        value = row["values"].get(key)
+        if section != row["section"] or not isinstance(value, (int, float)):
+            continue
+        base = sorted(v[key] for v in past[-METRICS_BASELINE_RUNS:] if isinstance(v.get(key), (int, float)))
+        if len(base) < METRICS_BASELINE_MIN:
+            continue
+        median = base[len(base) // 2]
+        if median <= 0:
+            continue
+        worse = (value - median) / median * 100 * direction
+        if worse > METRICS_REGRESSION_PCT and abs(value - median) >= min_delta:
+            regressions.append((key, value, median, round(worse, 1)))
+    return regressions
+
+
+def report_regressions(regressions):
+    if not regressions:
+        return
+    live_print(f"📉 性能回归（相对最近 {METRICS_BASELINE_RUNS} 次中位数，阈值 {METRICS_REGRESSION_PCT:g}%）:")
+    write_summary(f"\n#### 📉 性能回归（基线: 最近 {METRICS_BASELINE_RUNS} 次中位数）\n")
+    write_summary("| 指标 | 本次 | 基线 | 劣化 |")
+    write_summary("|------|------|------|------|")
+    for key, value, base, pct in regressions:
+        live_print(f"   ⚠️ {key}: {value:g} (基线 {base:g}, 劣化 {pct:g}%)", LOG_WARN)
+        write_summary(f"| {key} | {value:g} | {base:g} | {pct:g}% |")
+
+
+# ===============================
+# 自适应并发窗口（AIMD）
+# ===============================
+ADAPTIVE_CONCURRENCY = os.environ.get("ADAPTIVE_CONCURRENCY", "1") != "0"
+ADAPTIVE_INTERVAL = 2.0        # 每 2s 评估一次窗口
+ADAPTIVE_MIN_SAMPLES = 20      # 评估周期内完成数不足则不调整（样本太少不可信）
+ADAPTIVE_LAG_LIMIT = 0.1       # 事件循环调度延迟超过 100ms 视为 CPU 饱和
+ADAPTIVE_TIMEOUT_MARGIN = 0.15 # 超时率高出基线 15 个百分点视为网络拥塞
+ADAPTIVE_DECREASE = 0.7        # 乘性减小系数
+TIMEOUT_SLACK = 0.95           # 失败且耗时达到超时阈值的 95% 即视为超时（计时误差余量）
+
+# 事件循环监控（可选）：调度延迟、在途任务数、并发窗口等待、asyncio.wait 记账开销
+LOOP_MONITOR = os.environ.get("LOOP_MONITOR", "0") == "1"
+LOOP_MONITOR_PERIOD = 0.05                                                   # 延迟采样周期（秒）
+LOOP_MONITOR_INTERVAL = float(os.environ.get("LOOP_MONITOR_INTERVAL", "10"))  # 周期报告间隔（秒）
+
+
+async def sample_loop_lag(period, sink):
+    """每 period 秒 sleep 一次，把实际唤醒相对预期的延迟（秒）交给 sink；直到被取消"""
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(period)
+        sink(loop.time() - t0 - period)
+
+
+class AdaptiveLimiter:
+    """AIMD 自适应并发窗口，可替代 asyncio.Semaphore（async with limiter: ...）。
+
+    - limit 为当前在途上限，滚动窗口补任务时以 limiter.limit 为准
+    - 调用方完成一次任务后 record(elapsed, timed_out) 上报耗时与是否超时
+    - 每 ADAPTIVE_INTERVAL 秒按完成速率、超时率（相对基线）与事件循环延迟调整窗口：
+      延迟过高或超时率高于基线 → 乘性减小；窗口被打满且指标健康 → 加性增大
+    - ADAPTIVE_CONCURRENCY=0 时退化为固定窗口（等价于原 Semaphore）
+    - metrics: 记录排队耗时（LOOP_MONITOR 开启时）的 Metrics，默认 METRICS
+    """
+
+    def __init__(self, name, initial, minimum=None, maximum=None, timeout_hint=None, metrics=METRICS):
+        self.name = name
+        self.metrics = metrics
+        self.initial = max(1, int(initial))
+        self.limit = self.initial
+        self.minimum = max(1, int(minimum) if minimum else self.initial // 4)
+        self.maximum = max(self.initial, int(maximum) if maximum else self.initial * 4)
+        self.step = max(1, self.initial // 10)
+        self.timeout_hint = timeout_hint
+        self.enabled = ADAPTIVE_CONCURRENCY
+        self.decisions = []  # [(秒, 旧窗口, 新窗口, 原因), ...]
+        self.peak = self.limit
+        self.floor = self.limit
+        self._in_flight = 0
+        self._cond = None
+        self._start = time.monotonic()
+        self._reset_window(self._start)
+        self._baseline_timeout = None
+        self._lag_task = None
+        self._lag_max = 0.0
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._completed = 0
+        self._timeouts = 0
+        self._saturated = False
+
+    async def __aenter__(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+            if self.enabled and self._lag_task is None:
+                self._lag_task = asyncio.get_running_loop().create_task(self._sample_lag())
+        t0 = time.perf_counter() if LOOP_MONITOR else None
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+            # 窗口被打满（调用方确实有更多并发需求）才允许加性增大
+            if self._in_flight >= self.limit:
+                self._saturated = True
+        if t0 is not None:
+            self.metrics.observe(f"limiter.{self.name}.wait_ms", (time.perf_counter() - t0) * 1000)
+        return self
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify(max(1, self.limit - self._in_flight))
+        return False
+
+    async def _sample_lag(self):
+        def sink(lag):
+            self._lag_max = max(self._lag_max, lag)
+        await sample_loop_lag(0.25, sink)
+
+    def record(self, elapsed, timed_out=None):
+        """上报一次完成；timed_out 为 None 时按 timeout_hint 估算（耗时触及超时阈值即视为超时）"""
+        if timed_out is None:
+            timed_out = self.timeout_hint is not None and elapsed >= self.timeout_hint * TIMEOUT_SLACK
+        self._completed += 1
+        if timed_out:
+            self._timeouts += 1
+        now = time.monotonic()
+        if self.enabled and now - self._window_start >= ADAPTIVE_INTERVAL:
+            self._adjust(now)
+
+    def _adjust(self, now):
+        if self._completed < ADAPTIVE_MIN_SAMPLES:
+            return
+        rate = self._completed / (now - self._window_start)
+        timeout_ratio = self._timeouts / self._completed
+        lag, saturated = self._lag_max, self._saturated
+        self._lag_max = 0.0
+        self._reset_window(now)
+
+        # 超时率基线：取历史最小值并缓慢上浮，适应“大部分目标本来就不可达”的扫描场景
+        if self._baseline_timeout is None:
+            self._baseline_timeout = timeout_ratio
+        else:
+            self._baseline_timeout = min(timeout_ratio, self._baseline_timeout + 0.01)
+
+        old = self.limit
+        if lag > ADAPTIVE_LAG_LIMIT:
+            new, reason = int(old * ADAPTIVE_DECREASE), f"loop-lag {lag*1000:.0f}ms"
+        elif timeout_ratio > self._baseline_timeout + ADAPTIVE_TIMEOUT_MARGIN:
+            new, reason = int(old * ADAPTIVE_DECREASE), f"timeout {timeout_ratio:.0%} (基线 {self._baseline_timeout:.0%})"
+        elif saturated:
+            new, reason = old + self.step, f"{rate:.0f}/s 健康"
+        else:
+            return
+        new = max(self.minimum, min(self.maximum, new))
+        if new == old:
+            return
+        self.limit = new
+        self.peak, self.floor = max(self.peak, new), min(self.floor, new)
+        self.decisions.append((round(now - self._start, 1), old, new, reason))
+        if new < old:
+            live_print(f" 🎚️ [{self.name}] 并发窗口 {old}→{new} ({reason})")
+        if self._cond is not None:
+            asyncio.get_running_loop().create_task(self._wake())
+
+    async def _wake(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    def close(self):
+        """停止事件循环延迟采样（阶段结束时调用）"""
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+
+    def summary(self):
+        """单行摘要：初始→最终窗口、峰谷值与增减次数"""
+        ups = sum(1 for _, old, new, _ in self.decisions if new > old)
+        downs = len(self.decisions) - ups
+        mode = "自适应" if self.enabled else "固定"
+        return (f"{self.name}: {self.initial}→{self.limit} ({mode}, 区间 {self.floor}~{self.peak}, "
+                f"↑{ups} ↓{downs})")
+
+    def summary_lines(self, last=5):
+        """摘要 + 最近几次窗口调整记录，供阶段摘要打印"""
+        lines = [self.summary()]
+        for t, old, new, reason in self.decisions[-last:]:
+            lines.append(f"  +{t:>6.1f}s {old}→{new} {reason}")
+        return lines
+
+
+class _BusyTimer:
+    """包装协程：只累计它自身同步执行片段的耗时（每次 send / throw），不含挂起等待的时间"""
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.busy = 0.0
+
+    def __await__(self):
+        coro, value, exc = self.coro, None, None
+        while True:
+            t0 = time.perf_counter()
+            try:
+                future = coro.send(value) if exc is None else coro.throw(exc)
+            except StopIteration as stop:
+                self.busy += time.perf_counter() - t0
+                return stop.value
+            finally:
+                value = exc = None
+            self.busy += time.perf_counter() - t0
+            try:
+                value = yield future
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                exc = e
+
+
+class LoopMonitor:
+    """事件循环监控（LOOP_MONITOR=1 启用，否则所有方法为空操作 / 直通）。
+
+    - 调度延迟：每 LOOP_MONITOR_PERIOD 秒采样一次，记入 METRICS 直方图 loop.<name>.lag_ms
+    - 在途任务：采样时的 asyncio.all_tasks() 数量（均值 / 峰值）
+    - 并发窗口等待：AdaptiveLimiter 在启用时记录 limiter.<名>.wait_ms，这里汇总 limiters 的 p50 / p99
+    - asyncio.wait 记账：滚动窗口通过 monitor.wait(pending) 调用，只计 asyncio.wait 自身执行的时间
+      （为每个 pending 任务挂 / 摘回调、划分 done / pending），与墙钟之比即事件循环花在记账上的比例
+    每 LOOP_MONITOR_INTERVAL 秒打印一行，stop() 返回摘要行并写入 METRICS。
+    """
+
+    def __init__(self, name, limiters=()):
+        self.name = name
+        self.limiters = list(limiters)
+        self.enabled = LOOP_MONITOR
+        self._task = None
+        self._reset()
+
+    def _reset(self):
+        self._started = time.monotonic()
+        self._lag_max = 0.0
+        self._task_samples = 0
+        self._task_total = 0
+        self._task_max = 0
+        self._wait_calls = 0
+        self._wait_busy = 0.0
+        self._wait_size = 0
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._reset()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    async def wait(self, pending):
+        """等价于 asyncio.wait(pending, return_when=FIRST_COMPLETED)，启用时统计记账开销"""
+        if not self.enabled:
+            return await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        self._wait_calls += 1
+        self._wait_size += len(pending)
+        timer = _BusyTimer(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+        try:
+            return await timer
+        finally:
+            self._wait_busy += timer.busy
+
+    def _sample(self, lag):
+        self._lag_max = max(self._lag_max, lag)
+        METRICS.observe(f"loop.{self.name}.lag_ms", lag * 1000)
+        tasks = len(asyncio.all_tasks())
+        self._task_samples += 1
+        self._task_total += tasks
+        self._task_max = max(self._task_max, tasks)
+
+    async def _run(self):
+        sampler = asyncio.get_running_loop().create_task(sample_loop_lag(LOOP_MONITOR_PERIOD, self._sample))
+        try:
+            while True:
+                await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+                live_print(f" 🩺 [{self.name}] {self._line()}")
+        finally:
+            sampler.cancel()
+
+    def _line(self):
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        lag = METRICS.histograms.get(f"loop.{self.name}.lag_ms")
+        parts = [f"延迟 p50/p99/max {lag.percentile(0.5) if lag else '-'}/{lag.percentile(0.99) if lag else '-'}/"
+                 f"{self._lag_max * 1000:.0f}ms",
+                 f"任务 均值 {self._task_total / max(self._task_samples, 1):.0f} 峰值 {self._task_max}"]
+        if self._wait_calls:
+            parts.append(f"wait {self._wait_calls} 次 (均 {self._wait_size / self._wait_calls:.0f} 个) "
+                         f"记账 {self._wait_busy:.2f}s ({self._wait_busy / elapsed:.1%})")
+        for limiter in self.limiters:
+            hist = METRICS.histograms.get(f"limiter.{limiter.name}.wait_ms")
+            if hist is not None:
+                parts.append(f"{limiter.name} 等待 p50/p99 {hist.percentile(0.5)}/{hist.percentile(0.99)}ms")
+        return " | ".join(parts)
+
+    def stop(self):
+        """停止采样，返回摘要行（未启用时为空列表）"""
+        if self._task is None:
+            return []
+        self._task.cancel()
+        self._task = None
+        line = f"{self.name}: {self._line()}"
+        METRICS.gauge(f"loop.{self.name}.tasks_max", self._task_max)
+        METRICS.gauge(f"loop.{self.name}.wait_calls", self._wait_calls)
+        METRICS.gauge(f"loop.{self.name}.wait_busy_s", round(self._wait_busy, 3))
+        return [line]